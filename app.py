@@ -1,42 +1,476 @@
-from flask import Flask, render_template, request, redirect, url_for, session, flash
+from flask import Flask, render_template, request, redirect, url_for, session, flash, jsonify, make_response, abort
+from jinja2 import FileSystemBytecodeCache
+from markupsafe import Markup
+from werkzeug.http import is_resource_modified
 import sqlite3
-from werkzeug.security import generate_password_hash, check_password_hash
+import base64
+import hmac
+import json
+import re
+import os
+import time
 import uuid # For generating friend codes
+import click
+from contextlib import contextmanager
+from game_cache import GameCache
+from fragment_cache import FragmentCache
+from db_pool import ConnectionPool
+from password_hashing import PasswordHasher, HashingBusy
+from cart_store import CartStore
+from group_commit import GroupCommitWriter
+from ownership_index import OwnershipIndex
+from metrics import RouteMetrics, TrackedConnection, request_stats
+from async_db import AsyncDatabase
+from shard_router import SHARDED_TABLES, ShardRouter, reshard, seed_purchase_ids
+import user_counters
+import recommendations
+from http_caching import StaticFingerprints, compress_response, make_etag
+from exports import EXPORTS, EXPORT_FORMATS, csv_chunks, merged_export_batches, ndjson_chunks, parse_since
+import atexit
+import asyncio
+import heapq
+import itertools
+from collections import Counter
 
 app = Flask(__name__)
 app.secret_key = 'your_very_secret_key'  # Change this in a real application!
-DATABASE = 'game_store.db'
+DATABASE = os.environ.get('GAME_STORE_DATABASE', 'game_store.db')
+
+# Per-worker connection pool settings. The PRAGMAs are applied once when a
+# pooled connection is opened; WAL lets storefront readers run alongside writers.
+DB_POOL_SIZE = 8
+DB_POOL_TIMEOUT = 5.0 # seconds to wait for a free connection
+SQLITE_CACHED_STATEMENTS = 256 # per-connection prepared statement cache
+SQLITE_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'busy_timeout': 5000, # ms
+    'synchronous': 'NORMAL',
+    'cache_size': -20000, # negative = KiB, so ~20 MB of page cache
+    'mmap_size': 268435456, # 256 MB
+}
+# Password hashing runs on a small process pool per web worker. Changing
+# PASSWORD_HASH_METHOD (method plus cost parameters, in werkzeug's format)
+# takes effect for existing users as they log in, see login().
+PASSWORD_HASH_METHOD = 'scrypt:32768:8:1'
+PASSWORD_HASH_WORKERS = 2 # 0 hashes in the request thread
+PASSWORD_HASH_QUEUE_DEPTH = 32 # requests waiting for a worker before we answer 503
+PASSWORD_HASH_TIMEOUT = 10.0 # seconds
+
+# Statements slower than this are logged with their query plan (seconds;
+# None turns the slow-query log off)
+SLOW_QUERY_THRESHOLD = 0.1
+route_metrics = RouteMetrics()
+
+# Responses: compress HTML/JSON bodies of at least this many bytes, and let
+# browsers keep fingerprinted static files (style.css?v=<hash>) for a year.
+COMPRESS_MIN_SIZE = 1024
+STATIC_MAX_AGE = 365 * 24 * 3600
+static_fingerprints = StaticFingerprints(app.static_folder)
+
+GAMES_PER_PAGE = 24
+MAX_GAMES_PER_PAGE = 100
+
+# Columns rendered by a storefront game card. The description is trimmed so a
+# page never drags full-length descriptions into memory.
+CARD_DESCRIPTION_LENGTH = 300
+GAME_CARD_COLUMNS = (f'id, title, substr(description, 1, {CARD_DESCRIPTION_LENGTH}) AS description, '
+                     'price, genre, release_date, developer, image_url')
+
+# Storefront sort orders: name -> (column, direction). Each one is served by a
+# (column, id) index from database_setup.migration_storefront_indexes, and the id tiebreaker
+# makes the ordering total so it can be used as a keyset cursor.
+GAME_SORTS = {
+    'title': ('title', 'ASC'),
+    'price_asc': ('price', 'ASC'),
+    'price_desc': ('price', 'DESC'),
+    'newest': ('release_date', 'DESC'),
+}
+DEFAULT_GAME_SORT = 'title'
+
+SEARCH_RESULTS_PER_PAGE = 20
+MAX_SEARCH_PAGES = 10 # ranked results are only worth paging so deep
+AUTOCOMPLETE_LIMIT = 8
+# bm25 column weights for games_fts (title, description, developer, genre)
+SEARCH_WEIGHTS = (10.0, 1.0, 3.0, 2.0)
+
+FRIEND_SUGGESTION_LIMIT = 10
+FRIEND_SUGGESTION_FANOUT = 1000 # friends whose own friends are considered
+
+# "Recommended for you": the similar-games lists (see recommendations.py) of
+# a user's most recent purchases, merged by score
+RECOMMENDATION_SEED_GAMES = 20
+RECOMMENDATIONS_SHOWN = 6
+FRIENDS_WHO_OWN_LIMIT = 20
+
+# Carts live server-side in cart_items; the session cookie only identifies
+# the user. CART_WRITE_BACK batches cart writes in memory and flushes them
+# every CART_FLUSH_INTERVAL seconds (needs sticky sessions across workers);
+# without it, cached carts are checked against the user's cart version.
+CART_CACHE_USERS = 10000
+CART_WRITE_BACK = False
+CART_FLUSH_INTERVAL = 2.0
+
+# Group commit: with GAME_STORE_GROUP_COMMIT=1, write transactions (friend
+# requests, carts, checkouts) are queued to one writer thread per database
+# file, which commits everything queued meanwhile as one transaction. Its
+# connection uses synchronous=FULL: an acknowledged write survives a power
+# cut, and the fsync is shared by the batch (see group_commit.py).
+GROUP_COMMIT = os.environ.get('GAME_STORE_GROUP_COMMIT') == '1'
+GROUP_COMMIT_MAX_BATCH = 64
+GROUP_COMMIT_MAX_DELAY = 0.0 # extra seconds to wait for more writes; 0 = those queued during the last commit
+GROUP_COMMIT_TIMEOUT = 30.0 # seconds a request waits for its commit before failing with sqlite3.OperationalError
+_writers = {}
+
+def get_writer(database=None):
+    database = database or DATABASE
+    if database not in _writers:
+        _writers[database] = GroupCommitWriter(database, max_batch=GROUP_COMMIT_MAX_BATCH,
+                                               max_delay=GROUP_COMMIT_MAX_DELAY,
+                                               timeout=GROUP_COMMIT_TIMEOUT,
+                                               pragmas={**SQLITE_PRAGMAS, 'synchronous': 'FULL'},
+                                               slow_threshold=SLOW_QUERY_THRESHOLD)
+    return _writers[database]
+
+cart_store = CartStore(max_users=CART_CACHE_USERS, write_back=CART_WRITE_BACK,
+                       flush_interval=CART_FLUSH_INTERVAL, writer=get_writer() if GROUP_COMMIT else None)
+
+# Shared cache of games rows by id, see get_games()
+GAME_CACHE_SIZE = 1024
+game_cache = GameCache(max_size=GAME_CACHE_SIZE)
+
+# Owned game ids per user, for Owned badges and checkout, see ownership_index.py
+OWNERSHIP_INDEX_MAX_IDS = 5_000_000 # ~20 MB
+ownership_index = OwnershipIndex(max_ids=OWNERSHIP_INDEX_MAX_IDS)
+
+# Rendered game cards, shared by every page that lists games, see game_card()
+FRAGMENT_CACHE_SIZE = 4096
+GAME_CARD_TEMPLATES = {
+    'store': 'cards/store.html', # index and search
+    'cart': 'cards/cart.html',
+    'checkout': 'cards/checkout.html',
+    'library': 'cards/library.html',
+}
+fragment_cache = FragmentCache(max_size=FRAGMENT_CACHE_SIZE)
+
+# Compiled templates are kept on disk so new workers skip compiling them
+JINJA_CACHE_DIR = os.environ.get('GAME_STORE_JINJA_CACHE', os.path.join(app.instance_path, 'jinja_cache'))
+os.makedirs(JINJA_CACHE_DIR, exist_ok=True)
+app.jinja_env.bytecode_cache = FileSystemBytecodeCache(JINJA_CACHE_DIR)
+
+# Bulk exports (/api/games, /api/purchases) are for partners and analytics
+# jobs holding this token; without one configured the endpoints are off.
+EXPORT_API_TOKEN = os.environ.get('GAME_STORE_EXPORT_TOKEN')
+
+# Purchases and friend edges can be spread over several SQLite files by user
+# id (see shard_router.py); the catalog, users and carts stay in DATABASE.
+# GAME_STORE_SHARDS must match the layout `flask reshard` last produced.
+SHARD_COUNT = int(os.environ.get('GAME_STORE_SHARDS', '1'))
+shard_router = ShardRouter(DATABASE, SHARD_COUNT)
+
+_pools = {}
+_hasher = None
+
+def get_hasher():
+    global _hasher
+    if _hasher is None or _hasher.pid != os.getpid():
+        _hasher = PasswordHasher(method=PASSWORD_HASH_METHOD, workers=PASSWORD_HASH_WORKERS,
+                                 queue_depth=PASSWORD_HASH_QUEUE_DEPTH, timeout=PASSWORD_HASH_TIMEOUT)
+    return _hasher
+
+def hashing_busy(template):
+    # The hashing queue is full: shed load rather than queueing more work
+    flash('The server is busy right now. Please try again in a moment.', 'warning')
+    return render_template(template), 503, {'Retry-After': '5'}
+
+def get_pool(database=None):
+    # One pool per database file and worker process; a forked worker must not reuse its parent's
+    database = database or DATABASE
+    pool = _pools.get(database)
+    if pool is None or pool.pid != os.getpid():
+        pool = _pools[database] = ConnectionPool(database, size=DB_POOL_SIZE, timeout=DB_POOL_TIMEOUT,
+                                                 pragmas=SQLITE_PRAGMAS, cached_statements=SQLITE_CACHED_STATEMENTS)
+    return pool
+
+# Async mode: with GAME_STORE_ASYNC_VIEWS=1 the friends, cart and library pages
+# are served by async variants that run their independent reads concurrently,
+# each on its own pooled connection (needs Flask[async], see requirements.txt).
+# Run the app under a threaded WSGI server, or an ASGI server through asgi.py,
+# which gives each request its own thread so requests overlap in a worker.
+ASYNC_VIEWS = os.environ.get('GAME_STORE_ASYNC_VIEWS') == '1'
+async_db = AsyncDatabase(get_pool, threads=DB_POOL_SIZE, slow_threshold=SLOW_QUERY_THRESHOLD)
 
 def get_db():
-    db = getattr(g, '_database', None)
+    # Every statement goes through TrackedConnection, which feeds /metrics
+    db = getattr(g, '_tracked_database', None)
     if db is None:
-        db = g._database = sqlite3.connect(DATABASE)
-        db.row_factory = sqlite3.Row # Access columns by name
+        g._database = get_pool().acquire()
+        db = g._tracked_database = TrackedConnection(g._database, slow_threshold=SLOW_QUERY_THRESHOLD)
     return db
 
+def get_shard_db(user_id=None, database=None):
+    """The request's connection to the shard holding `user_id`'s purchases and friend edges.
+
+    Pass `database` instead to get a particular shard file. With one shard
+    this is simply get_db().
+    """
+    database = database or shard_router.database_for(user_id)
+    if database == DATABASE:
+        return get_db()
+    shards = g.setdefault('_shard_databases', {})
+    if database not in shards:
+        conn = get_pool(database).acquire()
+        shards[database] = (conn, TrackedConnection(conn, slow_threshold=SLOW_QUERY_THRESHOLD))
+    return shards[database][1]
+
 @app.teardown_appcontext
 def close_connection(exception):
-    db = getattr(g, '_database', None)
+    # Hand the connections back to their pools instead of closing them
+    g.pop('_tracked_database', None)
+    db = g.pop('_database', None)
     if db is not None:
-        db.close()
+        get_pool().release(db)
+    for database, (conn, _) in g.pop('_shard_databases', {}).items():
+        get_pool(database).release(conn)
+
+@app.before_request
+def start_request_timer():
+    g._request_start = time.perf_counter()
+
+@app.teardown_request
+def record_request_metrics(exception):
+    start = g.pop('_request_start', None)
+    if start is not None:
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        route_metrics.observe(route, time.perf_counter() - start, request_stats())
+    g.pop('_query_stats', None)
 
 def query_db(query, args=(), one=False):
-    cur = get_db().execute(query, args)
-    rv = cur.fetchall()
-    cur.close()
+    rv = get_db().query(query, args)
     return (rv[0] if rv else None) if one else rv
 
-def execute_db(query, args=()):
-    db = get_db()
-    cur = db.execute(query, args)
+def execute_db(query, args=(), database=None):
+    # One statement as its own write transaction, see write()
+    write(lambda db: db.execute(query, args).close(), database=database)
+
+def query_shard(user_id, query, args=(), one=False):
+    # query_db() on the shard of `user_id`
+    rv = get_shard_db(user_id).query(query, args)
+    return (rv[0] if rv else None) if one else rv
+
+def query_all_shards(query, args=()):
+    """Run a read on every shard and return all the rows, shard after shard."""
+    rows = []
+    for database in shard_router.databases():
+        rows.extend(get_shard_db(database=database).query(query, args))
+    return rows
+
+@contextmanager
+def transaction(db=None):
+    """Run a unit of work in one IMMEDIATE transaction on the request's connection.
+
+    Pass `db` (e.g. get_shard_db(user_id)) to use another connection.
+    Commits when the block exits normally and rolls back if it raises.
+    """
+    db = db or get_db()
+    db.execute('BEGIN IMMEDIATE') # take the write lock up front
+    try:
+        yield db
+    except BaseException:
+        db.rollback()
+        raise
     db.commit()
-    cur.close()
+
+def write(fn, *args, database=None):
+    """Run fn(db, *args) as one write transaction on `database` and return its result.
+
+    With GROUP_COMMIT it goes through that file's group-commit writer and
+    this waits until the batch it joined is committed; otherwise it runs in
+    transaction() on the request's connection. Either way fn must not
+    commit, and nothing it wrote is kept if it raises.
+    """
+    if GROUP_COMMIT:
+        return get_writer(database).run(fn, *args)
+    with transaction(get_shard_db(database=database or DATABASE)) as db:
+        return fn(db, *args)
+
+def get_cart_ids():
+    return cart_store.get(get_db(), session['user_id'])
+
+def get_cart_count():
+    return cart_store.count(get_db(), session['user_id'])
+
+@app.after_request
+def flush_carts(response):
+    # Write-back mode: persist dirty carts once the flush interval has passed
+    if cart_store.flush_due():
+        cart_store.flush(get_db())
+    return response
+
+@app.url_defaults
+def fingerprint_static_urls(endpoint, values):
+    # url_for('static', filename=...) gets ?v=<content hash>, so the file can be cached forever
+    if endpoint == 'static' and 'v' not in values:
+        fingerprint = static_fingerprints.get(values.get('filename', ''))
+        if fingerprint:
+            values['v'] = fingerprint
+
+@app.after_request
+def cache_and_compress(response):
+    if request.endpoint == 'static' and request.args.get('v'):
+        response.cache_control.no_cache = None
+        response.cache_control.public = True
+        response.cache_control.max_age = STATIC_MAX_AGE
+        response.cache_control.immutable = True
+    return compress_response(response, request.headers.get('Accept-Encoding', ''), min_size=COMPRESS_MIN_SIZE)
+
+@atexit.register
+def close_writers_at_exit():
+    # Commit whatever is still queued
+    for writer in _writers.values():
+        writer.close()
+
+@atexit.register
+def flush_carts_at_exit():
+    if cart_store.write_back:
+        db = sqlite3.connect(DATABASE)
+        cart_store.flush(db)
+        db.close()
+
+def get_catalog_version(db=None):
+    # Read once per request; triggers on games bump it on every write
+    if 'catalog_version' not in g:
+        rows = (db or get_db()).query('SELECT version FROM catalog_version WHERE id = 1')
+        row = rows[0] if rows else None
+        g.catalog_version = row['version'] if row else 0
+    return g.catalog_version
+
+def get_recommendations_version(db=None):
+    # Read once per request; every `flask build-recommendations` run bumps it
+    if 'recommendations_version' not in g:
+        rows = (db or get_db()).query('SELECT version FROM recommendation_version WHERE id = 1')
+        g.recommendations_version = rows[0]['version'] if rows else 0
+    return g.recommendations_version
+
+def get_purchase_version(user_id, db=None):
+    """Version of a user's purchases; bumped by triggers on purchases."""
+    rows = (db or get_shard_db(user_id)).query('SELECT version FROM purchase_versions WHERE user_id = ?', [user_id])
+    return rows[0]['version'] if rows else 0
+
+def read_user_counters(user_id, db):
+    # The user's row of user_counters in one database file, or None
+    rows = db.query(f"SELECT {', '.join(user_counters.COUNTER_COLUMNS)} FROM user_counters WHERE user_id = ?", [user_id])
+    return rows[0] if rows else None
+
+def get_user_counters(user_id):
+    """Owned games, friends and pending requests of a user: a primary-key read per shard.
+
+    The counters are kept by triggers (see user_counters.py) and read once per request.
+    """
+    if 'user_counters' not in g:
+        g.user_counters = user_counters.add_counters(
+            read_user_counters(user_id, get_shard_db(database=database)) for database in shard_router.databases())
+    return g.user_counters
+
+@app.context_processor
+def inject_user_counters():
+    # For the navbar badges on every page
+    if 'user_id' not in session:
+        return {}
+    return {'user_counters': get_user_counters(session['user_id'])}
+
+def conditional_render(validators, render):
+    """Answer 304 Not Modified if the client's copy was built from the same validators.
+
+    `validators` are every value the page depends on; `render` is only called
+    when the page actually has to be rendered. Only an ETag is sent: several
+    validators (cart count, badges) have no timestamp, so a Last-Modified
+    date would let If-Modified-Since alone revalidate a stale page.
+    """
+    if '_flashes' in session:
+        # Pending flash messages make this one render unlike any other
+        return render()
+    etag = make_etag(request.full_path, *validators)
+    if is_resource_modified(request.environ, etag=etag):
+        response = make_response(render())
+    else:
+        response = app.response_class(status=304)
+    return set_validators(response, etag)
+
+async def conditional_render_async(validators, render):
+    """conditional_render() for async views, where `render` is a coroutine function."""
+    if '_flashes' in session:
+        return await render()
+    etag = make_etag(request.full_path, *validators)
+    if is_resource_modified(request.environ, etag=etag):
+        response = make_response(await render())
+    else:
+        response = app.response_class(status=304)
+    return set_validators(response, etag)
+
+def set_validators(response, etag):
+    # Weak: the tag names what the page was built from, not its bytes, so the
+    # gzip/br variants and the 304 all carry the same one (see compress_response)
+    response.set_etag(etag, weak=True)
+    # Per-user pages: browsers may keep them but must revalidate every time
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
+
+def get_games(game_ids, db=None):
+    """Look up games by id through the shared game cache.
+
+    Returns the rows (as dicts) in the order of `game_ids`, skipping ids that
+    don't exist.
+    """
+    db = db or get_db()
+    game_ids = [int(game_id) for game_id in game_ids]
+    game_cache.sync_version(get_catalog_version(db))
+
+    def load(missing_ids):
+        placeholders = ','.join(['?'] * len(missing_ids))
+        return db.query(f'SELECT * FROM games WHERE id IN ({placeholders})', missing_ids)
+
+    found = game_cache.get_many(game_ids, load)
+    return [found[game_id] for game_id in game_ids if game_id in found]
+
+@app.template_global()
+def game_card(kind, game, owned=False):
+    """The rendered card of one game, cached per (kind, game id, owned) and catalog version.
+
+    Apart from the Owned variant, cards only show catalog data, so anything
+    else per user (purchase dates) has to stay in the page template around them.
+    """
+    fragment_cache.sync_version(get_catalog_version())
+    template = app.jinja_env.get_template(GAME_CARD_TEMPLATES[kind])
+
+    def render():
+        card = game
+        if kind == 'store' and card['description']:
+            # Store cards come from GAME_CARD_COLUMNS rows and full get_games() rows
+            # alike; trim here too, so the cached card doesn't depend on which came first
+            card = {**card, 'description': card['description'][:CARD_DESCRIPTION_LENGTH]}
+        return Markup(template.render(game=card, owned=owned))
+    return fragment_cache.get((kind, game['id'], owned), render)
+
+def get_game(game_id):
+    games = get_games([game_id])
+    return games[0] if games else None
 
 # Initialize database if it doesn't exist or is empty
 def init_db_command():
     """Clear existing data and create new tables."""
     import database_setup
-    database_setup.init_db()
+    database_setup.init_db(DATABASE)
+    # Shard files get the same schema, without the sample catalog, and each
+    # its own range of purchase ids
+    for database in shard_router.databases():
+        if database != DATABASE:
+            database_setup.init_db(database, sample_data=False)
+    conns = [sqlite3.connect(database) for database in shard_router.databases()]
+    seed_purchase_ids(conns)
+    for conn in conns:
+        conn.commit()
+        conn.close()
     print("Initialized the database.")
 
 @app.cli.command('init-db')
@@ -44,6 +478,139 @@ def init_db_cli_command():
     """Registers a command-line command to initialize the database."""
     init_db_command()
 
+@app.cli.command('migrate')
+@click.option('--target', type=int, default=None, help='Schema version to migrate up to (default: latest).')
+def migrate_cli_command(target):
+    """Apply pending schema migrations to the database."""
+    import database_setup
+    for database in dict.fromkeys([DATABASE, *shard_router.databases()]):
+        before = database_setup.schema_version(database)
+        applied = database_setup.migrate(database, target=target)
+        if applied:
+            print(f"Migrated {database} schema from version {before} to {applied[-1]}.")
+        else:
+            print(f"{database} schema is up to date (version {before}).")
+
+@app.cli.command('generate-data')
+@click.option('--scale', type=float, default=1.0, help='Multiply every default volume (e.g. 0.01 for a quick run).')
+@click.option('--users', type=int, default=None)
+@click.option('--games', type=int, default=None)
+@click.option('--purchases', type=int, default=None)
+@click.option('--avg-friends', type=int, default=None)
+@click.option('--seed', type=int, default=42, help='Same seed, same data.')
+def generate_data_cli_command(scale, users, games, purchases, avg_friends, seed):
+    """Fill the database with synthetic users, games, purchases and friendships."""
+    import generate_data
+    if SHARD_COUNT > 1:
+        raise click.UsageError('generate-data writes a single file: run it with GAME_STORE_SHARDS=1, '
+                               'then split the data with `flask reshard`.')
+    generate_data.generate(
+        DATABASE,
+        users=users or int(generate_data.DEFAULT_USERS * scale),
+        games=games or int(generate_data.DEFAULT_GAMES * scale),
+        purchases=purchases or int(generate_data.DEFAULT_PURCHASES * scale),
+        avg_friends=avg_friends or generate_data.DEFAULT_AVG_FRIENDS,
+        seed=seed)
+    print(f"Generated data in {DATABASE}. Every generated user's password is '{generate_data.GENERATED_PASSWORD}'.")
+
+@app.cli.command('reshard')
+@click.option('--shards', type=click.IntRange(min=1), required=True, help='Number of shards to move to.')
+def reshard_cli_command(shards):
+    """Move purchases and friend edges from GAME_STORE_SHARDS shards to --shards (stop the app first)."""
+    start = time.perf_counter()
+    reshard(DATABASE, SHARD_COUNT, shards)
+    print(f"Resharded from {SHARD_COUNT} to {shards} shard(s) in {time.perf_counter() - start:.1f}s. "
+          f"Start the app with GAME_STORE_SHARDS={shards}.")
+
+@app.cli.command('check-counters')
+@click.option('--repair', is_flag=True, help='Rebuild the counters of every database file that has drifted.')
+def check_counters_cli_command(repair):
+    """Compare user_counters with purchases and friends, e.g. after a bulk import."""
+    drifted = 0
+    for database in shard_router.databases():
+        conn = sqlite3.connect(database)
+        try:
+            count = user_counters.count_drift(conn)
+            print(f"{database}: {count:,} user(s) with drifted counters.")
+            if count and repair:
+                with conn:
+                    user_counters.rebuild(conn)
+                print(f"{database}: counters rebuilt.")
+            drifted += count
+        finally:
+            conn.close()
+    if drifted and not repair:
+        raise click.ClickException('counters have drifted; run again with --repair')
+
+@app.cli.command('build-recommendations')
+@click.option('--full', is_flag=True, help='Rescore every game instead of only those bought since the last run.')
+def build_recommendations_cli_command(full):
+    """Precompute the similar-games lists from purchases; run it periodically (e.g. from cron)."""
+    start = time.perf_counter()
+    counts = recommendations.build_recommendations(DATABASE, shard_router.databases(), full=full)
+    print(f"Scored {counts['games']:,} games ({counts['recommendations']:,} recommendations) "
+          f"in {time.perf_counter() - start:.1f}s.")
+
+@app.cli.command('benchmark')
+@click.option('--requests', type=int, default=200, help='Timed requests per route.')
+@click.option('--output', type=click.Path(dir_okay=False), default=None, help='Where to write the JSON report.')
+@click.option('--compare', 'baseline_path', type=click.Path(exists=True, dir_okay=False), default=None,
+              help='Earlier JSON report to check for regressions against.')
+@click.option('--tolerance', type=float, default=0.2, help='Allowed p95 slowdown versus the baseline (0.2 = 20%).')
+def benchmark_cli_command(requests, output, baseline_path, tolerance):
+    """Benchmark the main routes against the current database (it writes purchases)."""
+    import sys
+    import benchmark
+    report = benchmark.run(sys.modules[__name__], requests=requests)
+    print(benchmark.format_table(report))
+    output = output or f"benchmark-{report['created_at'].replace(':', '')}.json"
+    benchmark.save(report, output)
+    print(f"Saved results to {output}.")
+    if baseline_path:
+        with open(baseline_path) as f:
+            regressions = benchmark.compare(report, json.load(f), tolerance=tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            sys.exit(1)
+
+@app.cli.command('import-catalog')
+@click.argument('source', type=click.File('r', encoding='utf-8'))
+@click.option('--format', 'fmt', type=click.Choice(['csv', 'ndjson']), default=None,
+              help='Input format (default: from the file extension, else csv).')
+@click.option('--chunk-size', type=int, default=None, help='Rows per write transaction.')
+@click.option('--defer-indexes', is_flag=True,
+              help='Drop secondary indexes and search and version triggers for the load and rebuild them afterwards.')
+def import_catalog_cli_command(source, fmt, chunk_size, defer_indexes):
+    """Add or update games from a CSV or NDJSON file ('-' reads stdin)."""
+    import catalog_import
+    fmt = fmt or ('ndjson' if source.name.endswith(('.ndjson', '.jsonl')) else 'csv')
+    start = time.perf_counter()
+    counts = catalog_import.import_catalog(DATABASE, source, fmt=fmt, defer=defer_indexes,
+                                           chunk_size=chunk_size or catalog_import.IMPORT_CHUNK_SIZE)
+    elapsed = time.perf_counter() - start
+    print(f"Imported {counts['read']:,} rows in {elapsed:.1f}s ({counts['read'] / max(elapsed, 1e-9):,.0f}/s): "
+          f"{counts['written']:,} written, {counts['unchanged']:,} unchanged, {counts['skipped']:,} skipped.")
+
+@app.cli.command('export')
+@click.argument('name', type=click.Choice(sorted(EXPORTS)))
+@click.option('--format', 'fmt', type=click.Choice(EXPORT_FORMATS), default='ndjson')
+@click.option('--since', default=None, help='Only rows changed at or after this ISO date/datetime (UTC).')
+@click.option('--cursor', default=None, help='Resume after the row that carried this cursor.')
+@click.option('--limit', type=int, default=None)
+@click.option('--output', type=click.File('w'), default='-', help='File to write (default: stdout).')
+def export_cli_command(name, fmt, since, cursor, limit, output):
+    """Stream the games catalog or the purchase history as NDJSON or CSV."""
+    since_value = parse_since(since) if since else None
+    if since and since_value is None:
+        raise click.BadParameter('expected an ISO date or datetime', param_hint='--since')
+    after = decode_cursor(cursor) if cursor else None
+    if cursor and after is None:
+        raise click.BadParameter('not an export cursor', param_hint='--cursor')
+    batches = merged_export_batches(export_databases(name), name, since=since_value, after=after, limit=limit)
+    for chunk in (ndjson_chunks if fmt == 'ndjson' else csv_chunks)(name, batches, encode_cursor):
+        output.write(chunk)
+
 @app.route('/register', methods=['GET', 'POST'])
 def register():
     if request.method == 'POST':
@@ -66,7 +633,10 @@ def register():
             flash('Gamertag already exists.', 'danger')
             return redirect(url_for('register'))
 
-        password_hash = generate_password_hash(password)
+        try:
+            password_hash = get_hasher().hash(password)
+        except HashingBusy:
+            return hashing_busy('register.html')
         friend_code = str(uuid.uuid4()) # Generate a unique friend code
 
         try:
@@ -89,7 +659,19 @@ def login():
 
         user = query_db('SELECT * FROM users WHERE username = ?', [username], one=True)
 
-        if user and check_password_hash(user['password_hash'], password):
+        try:
+            valid = user is not None and get_hasher().check(user['password_hash'], password)
+        except HashingBusy:
+            return hashing_busy('login.html')
+
+        if valid:
+            # Upgrade hashes made with older cost settings while we have the password
+            if get_hasher().needs_rehash(user['password_hash']):
+                try:
+                    execute_db('UPDATE users SET password_hash = ? WHERE id = ?',
+                               [get_hasher().hash(password), user['id']])
+                except HashingBusy:
+                    pass # try again on a later login
             session['user_id'] = user['id']
             session['username'] = user['username']
             session['gamertag'] = user['gamertag']
@@ -105,15 +687,211 @@ def logout():
     flash('You have been logged out.', 'info')
     return redirect(url_for('login'))
 
+def encode_cursor(sort_value, game_id):
+    # Opaque keyset cursor: the sort column value and id of the last row shown
+    raw = json.dumps([sort_value, game_id]).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+def decode_cursor(cursor):
+    # None unless it is exactly what encode_cursor() makes: the cursor comes
+    # from the client and its values are bound straight into SQL
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        payload = json.loads(base64.urlsafe_b64decode(padded))
+    except (ValueError, TypeError):
+        return None
+    if not isinstance(payload, list) or len(payload) != 2:
+        return None
+    sort_value, game_id = payload
+    if isinstance(sort_value, bool) or not isinstance(sort_value, (str, int, float, type(None))):
+        return None
+    if isinstance(sort_value, int) and not -2**63 <= sort_value < 2**63:
+        return None
+    if isinstance(game_id, bool) or not isinstance(game_id, int) or not -2**63 <= game_id < 2**63:
+        return None
+    return sort_value, game_id
+
+def parse_float(value):
+    try:
+        return float(value) if value not in (None, '') else None
+    except ValueError:
+        return None
+
+def fetch_games_page(genre=None, min_price=None, max_price=None, released_after=None,
+                     released_before=None, sort=DEFAULT_GAME_SORT, cursor=None, per_page=GAMES_PER_PAGE):
+    """Return (games, next_cursor) for one keyset page of the storefront."""
+    column, direction = GAME_SORTS.get(sort, GAME_SORTS[DEFAULT_GAME_SORT])
+    where, args = [], []
+
+    if genre:
+        where.append('genre = ?')
+        args.append(genre)
+    if min_price is not None:
+        where.append('price >= ?')
+        args.append(min_price)
+    if max_price is not None:
+        where.append('price <= ?')
+        args.append(max_price)
+    if released_after:
+        where.append('release_date >= ?')
+        args.append(released_after)
+    if released_before:
+        where.append('release_date <= ?')
+        args.append(released_before)
+    if column == 'release_date':
+        # Undated titles have no place in a "newest" listing, and excluding them
+        # keeps the (release_date, id) row-value comparison below index-friendly.
+        where.append('release_date IS NOT NULL')
+    if cursor:
+        where.append(f"({column}, id) {'>' if direction == 'ASC' else '<'} (?, ?)")
+        args.extend(cursor)
+
+    where_sql = f"WHERE {' AND '.join(where)}" if where else ''
+    # Fetch one extra row to learn whether another page exists
+    rows = query_db(f'''
+        SELECT {GAME_CARD_COLUMNS} FROM games
+        {where_sql}
+        ORDER BY {column} {direction}, id {direction}
+        LIMIT ?
+    ''', args + [per_page + 1])
+
+    games = rows[:per_page]
+    next_cursor = None
+    if len(rows) > per_page:
+        last = games[-1]
+        next_cursor = encode_cursor(last[column], last['id'])
+    return games, next_cursor
+
 @app.route('/')
 def index():
     if 'user_id' not in session:
         return redirect(url_for('login'))
-    # Placeholder for the main store page
-    games = query_db('SELECT * FROM games')
+
+    sort = request.args.get('sort', DEFAULT_GAME_SORT)
+    if sort not in GAME_SORTS:
+        sort = DEFAULT_GAME_SORT
+    filters = {
+        'genre': request.args.get('genre') or None,
+        'min_price': parse_float(request.args.get('min_price')),
+        'max_price': parse_float(request.args.get('max_price')),
+        'released_after': request.args.get('released_after') or None,
+        'released_before': request.args.get('released_before') or None,
+    }
+    cursor = request.args.get('cursor')
+    after = decode_cursor(cursor) if cursor else None
+    if cursor and after is None:
+        abort(400, 'invalid cursor')
+    per_page = min(max(request.args.get('per_page', GAMES_PER_PAGE, type=int), 1), MAX_GAMES_PER_PAGE)
     # Get cart item count for navbar
-    cart_item_count = len(session.get('cart', {}))
-    return render_template('index.html', games=games, cart_item_count=cart_item_count)
+    cart_item_count = get_cart_count()
+
+    def render():
+        games, next_cursor = fetch_games_page(sort=sort, cursor=after,
+                                              per_page=per_page, **filters)
+
+        # Pagination links keep the current filters and only swap the cursor
+        page_args = {k: v for k, v in request.args.items() if k != 'cursor'}
+        next_url = url_for('index', cursor=next_cursor, **page_args) if next_cursor else None
+        first_url = url_for('index', **page_args) if cursor else None
+
+        # Distinct genres for the filter dropdown; answered from the genre index
+        genres = [row['genre'] for row in query_db('SELECT DISTINCT genre FROM games WHERE genre IS NOT NULL ORDER BY genre')]
+        owned_ids = ownership_index.owned_among(get_shard_db(session['user_id']), session['user_id'],
+                                                [game['id'] for game in games], version=purchase_version)
+        # Only above the first page of the unfiltered store
+        recommended = [] if cursor or any(filters.values()) else recommended_games(session['user_id'], purchase_version)
+        return render_template('index.html', games=games, cart_item_count=cart_item_count,
+                               genres=genres, sorts=GAME_SORTS.keys(), sort=sort, filters=filters,
+                               next_url=next_url, first_url=first_url, owned_ids=owned_ids,
+                               recommended=recommended)
+
+    # The page only changes with the catalog, the user's purchases, or the navbar badges
+    purchase_version = get_purchase_version(session['user_id'])
+    return conditional_render(
+        (session['user_id'], session.get('username'), get_catalog_version(), purchase_version, cart_item_count,
+         get_user_counters(session['user_id'])['pending_received'], get_recommendations_version()),
+        render)
+
+def fts_match_expression(text, prefix=False, column=None):
+    """Build an FTS5 MATCH expression from free text typed by a user.
+
+    Every word is quoted so FTS5 syntax characters in the input are treated as
+    plain text. With `prefix`, the last word also matches as a prefix (for
+    autocomplete while the user is still typing it).
+    """
+    terms = ['"{}"'.format(term.replace('"', '')) for term in re.findall(r'\w+', text)]
+    if not terms:
+        return None
+    if prefix:
+        terms[-1] += '*'
+    expression = ' '.join(terms)
+    return f'{column} : ({expression})' if column else expression
+
+@app.route('/search')
+def search():
+    if 'user_id' not in session:
+        return redirect(url_for('login'))
+
+    q = request.args.get('q', '').strip()
+    page = min(max(request.args.get('page', 1, type=int), 1), MAX_SEARCH_PAGES)
+    match = fts_match_expression(q)
+    games, has_next = [], False
+
+    if match:
+        # Games titled exactly q come first (a lookup on idx_games_title_nocase),
+        # then every other match by bm25. FTS5 scores the matches without
+        # touching games and the sorter only keeps the rows up to this page;
+        # games rows are read for those alone.
+        offset, wanted = (page - 1) * SEARCH_RESULTS_PER_PAGE, SEARCH_RESULTS_PER_PAGE + 1
+        exact_ids = [row['id'] for row in query_db(
+            'SELECT id FROM games WHERE title = ? COLLATE NOCASE ORDER BY id DESC', [q])]
+        ids = exact_ids[offset:offset + wanted]
+        if len(ids) < wanted:
+            ids += [row['rowid'] for row in query_db(f'''
+                SELECT rowid FROM games_fts
+                WHERE games_fts MATCH ? AND rowid NOT IN ({','.join('?' * len(exact_ids))})
+                ORDER BY bm25(games_fts, ?, ?, ?, ?)
+                LIMIT ? OFFSET ?
+            ''', [match, *exact_ids, *SEARCH_WEIGHTS, wanted - len(ids), max(offset - len(exact_ids), 0)])]
+        rows = {row['id']: row for row in query_db(f'''
+            SELECT id, title, substr(description, 1, {CARD_DESCRIPTION_LENGTH}) AS description, price,
+                   genre, release_date, developer, image_url
+            FROM games WHERE id IN ({','.join('?' * len(ids))})
+        ''', ids)} if ids else {}
+        ranked = [rows[game_id] for game_id in ids if game_id in rows]
+        games = ranked[:SEARCH_RESULTS_PER_PAGE]
+        has_next = len(ranked) > SEARCH_RESULTS_PER_PAGE and page < MAX_SEARCH_PAGES
+
+    owned_ids = ownership_index.owned_among(get_shard_db(session['user_id']), session['user_id'],
+                                            [game['id'] for game in games],
+                                            version=get_purchase_version(session['user_id'])) if games else set()
+    cart_item_count = get_cart_count()
+    return render_template('search.html', q=q, games=games, page=page, has_next=has_next,
+                           cart_item_count=cart_item_count, owned_ids=owned_ids)
+
+@app.route('/search/autocomplete')
+def search_autocomplete():
+    # Title suggestions for a partially typed query: titles starting with it
+    # (a range on idx_games_title_nocase), then titles with words starting
+    # with it. Neither is ranked, so both stop after a few index entries.
+    q = request.args.get('q', '').strip()
+    match = fts_match_expression(q, prefix=True, column='title')
+    if not match:
+        return jsonify([])
+    rows = query_db('''
+        SELECT id, title FROM games
+        WHERE title >= ? COLLATE NOCASE AND title < ? COLLATE NOCASE
+        ORDER BY title COLLATE NOCASE, id
+        LIMIT ?
+    ''', [q, q + '\U0010ffff', AUTOCOMPLETE_LIMIT])
+    if len(rows) < AUTOCOMPLETE_LIMIT:
+        rows += query_db(f'''
+            SELECT g.id, g.title FROM games_fts
+            JOIN games g ON g.id = games_fts.rowid
+            WHERE games_fts MATCH ? AND g.id NOT IN ({','.join('?' * len(rows))})
+            LIMIT ?
+        ''', [match, *(row['id'] for row in rows), AUTOCOMPLETE_LIMIT - len(rows)])
+    return jsonify([{'id': row['id'], 'title': row['title']} for row in rows])
 
 @app.route('/add_to_cart/<int:game_id>')
 def add_to_cart(game_id):
@@ -121,18 +899,13 @@ def add_to_cart(game_id):
         flash('Please log in to add items to your cart.', 'warning')
         return redirect(url_for('login'))
 
-    game = query_db('SELECT * FROM games WHERE id = ?', [game_id], one=True)
+    game = get_game(game_id)
     if not game:
         flash('Game not found.', 'danger')
         return redirect(url_for('index'))
 
-    cart = session.get('cart', {}) # cart is a dict of {game_id: quantity}
-
     # For simplicity, each game can be in the cart once.
-    # If you want quantities, you'd increment cart[str(game_id)]
-    cart[str(game_id)] = 1 # Using str(game_id) as session keys must be strings
-
-    session['cart'] = cart
+    cart_store.add(get_db(), session['user_id'], [game_id])
     flash(f"'{game['title']}' added to cart.", 'success')
     return redirect(url_for('index'))
 
@@ -141,29 +914,45 @@ def view_cart():
     if 'user_id' not in session:
         return redirect(url_for('login'))
 
-    cart_ids = session.get('cart', {}).keys()
+    cart_ids = get_cart_ids()
     games_in_cart = []
     total_price = 0
 
     if cart_ids:
-        # Create a placeholder string for the IN clause
-        placeholders = ','.join(['?'] * len(cart_ids))
-        games_in_cart = query_db(f'SELECT * FROM games WHERE id IN ({placeholders})', list(cart_ids))
+        games_in_cart = get_games(cart_ids)
         for game in games_in_cart:
             total_price += game['price']
 
-    cart_item_count = len(session.get('cart', {}))
+    cart_item_count = get_cart_count()
     return render_template('cart.html', games_in_cart=games_in_cart, total_price=total_price, cart_item_count=cart_item_count)
 
+@app.route('/cart/batch', methods=['POST'])
+def update_cart_batch():
+    """Add and remove several games at once: {"add": [ids], "remove": [ids]}."""
+    if 'user_id' not in session:
+        return jsonify({'error': 'login required'}), 401
+
+    payload = request.get_json(silent=True) or {}
+    if not isinstance(payload, dict):
+        return jsonify({'error': 'expected a JSON object'}), 400
+    try:
+        add_ids = [int(game_id) for game_id in payload.get('add', [])]
+        remove_ids = [int(game_id) for game_id in payload.get('remove', [])]
+    except (TypeError, ValueError):
+        return jsonify({'error': 'game ids must be integers'}), 400
+
+    db = get_db()
+    # Only games that exist can be added
+    added = cart_store.add(db, session['user_id'], [game['id'] for game in get_games(add_ids)])
+    removed = cart_store.remove(db, session['user_id'], remove_ids)
+    return jsonify({'added': added, 'removed': removed, 'count': get_cart_count()})
+
 @app.route('/remove_from_cart/<int:game_id>')
 def remove_from_cart(game_id):
     if 'user_id' not in session:
         return redirect(url_for('login'))
 
-    cart = session.get('cart', {})
-    if str(game_id) in cart:
-        del cart[str(game_id)]
-        session['cart'] = cart
+    if cart_store.remove(get_db(), session['user_id'], [game_id]):
         flash('Item removed from cart.', 'info')
     else:
         flash('Item not found in cart.', 'warning')
@@ -174,47 +963,76 @@ def checkout():
     if 'user_id' not in session:
         return redirect(url_for('login'))
 
-    cart_ids = session.get('cart', {}).keys()
+    user_id = session['user_id']
+    idempotency_key = request.form.get('idempotency_key') if request.method == 'POST' else None
+
+    # A retried or double-submitted order: the first attempt already went
+    # through (and emptied the cart)
+    if idempotency_key and query_shard(user_id, 'SELECT 1 FROM checkout_requests WHERE user_id = ? AND idempotency_key = ?',
+                                       [user_id, idempotency_key], one=True):
+        flash('This order has already been processed.', 'info')
+        return redirect(url_for('library'))
+
+    cart_ids = get_cart_ids()
     if not cart_ids:
         flash('Your cart is empty.', 'warning')
         return redirect(url_for('index'))
 
     if request.method == 'POST':
         # Simulate payment processing
-        user_id = session['user_id']
-
-        # Check if games are already owned (optional, good practice)
-        owned_games = query_db('SELECT game_id FROM purchases WHERE user_id = ?', [user_id])
-        owned_game_ids = {str(row['game_id']) for row in owned_games}
-
-        games_to_purchase = []
-        for game_id_str in cart_ids:
-            if game_id_str not in owned_game_ids:
-                games_to_purchase.append((user_id, int(game_id_str)))
-            else:
-                game = query_db('SELECT title FROM games WHERE id = ?', [int(game_id_str)], one=True)
-                flash(f"You already own '{game['title']}'. It was not added again.", "info")
+        cart_games = get_games(cart_ids)
+        cart_game_ids = [game['id'] for game in cart_games]
+
+        def place_order(db, cart_game_ids):
+            if idempotency_key:
+                # Claimed inside the same transaction as the purchases, so a
+                # concurrent retry either sees the whole order or none of it
+                claimed = db.execute('INSERT OR IGNORE INTO checkout_requests (user_id, idempotency_key) VALUES (?, ?)',
+                                     [user_id, idempotency_key]).rowcount
+                if not claimed:
+                    cart_game_ids = []
+
+            # Ownership comes from the in-memory index. The purchase version is read
+            # under the write lock, so the index is reloaded if it is at all out of date.
+            purchase_version = get_purchase_version(user_id, db)
+            owned_ids = ownership_index.owned_among(db, user_id, cart_game_ids, version=purchase_version)
+
+            games_to_purchase = [(user_id, game_id) for game_id in cart_game_ids if game_id not in owned_ids]
+            # OR IGNORE: the unique (user_id, game_id) index turns a racing duplicate into a no-op
+            db.executemany('INSERT OR IGNORE INTO purchases (user_id, game_id) VALUES (?, ?)', games_to_purchase)
+            new_purchase_version = get_purchase_version(user_id, db) if games_to_purchase else purchase_version
+            return purchase_version, new_purchase_version, owned_ids, games_to_purchase
 
+        try:
+            # Everything written here is on the user's shard
+            purchase_version, new_purchase_version, owned_ids, games_to_purchase = write(
+                place_order, cart_game_ids, database=shard_router.database_for(user_id))
+        except sqlite3.Error as e:
+            flash(f'An error occurred during purchase: {e}', 'danger')
+            return redirect(url_for('view_cart')) # Stay on cart page if error
 
         if games_to_purchase:
-            try:
-                execute_db('INSERT INTO purchases (user_id, game_id) VALUES (?, ?)', games_to_purchase)
-                flash('Purchase successful! Games added to your library.', 'success')
-            except sqlite3.Error as e:
-                flash(f'An error occurred during purchase: {e}', 'danger')
-                return redirect(url_for('view_cart')) # Stay on cart page if error
-
-        session.pop('cart', None) # Clear the cart
+            ownership_index.record_purchases(user_id, [game_id for _, game_id in games_to_purchase],
+                                             purchase_version, new_purchase_version)
+        for game in cart_games:
+            if game['id'] in owned_ids:
+                flash(f"You already own '{game['title']}'. It was not added again.", "info")
+        if games_to_purchase:
+            flash('Purchase successful! Games added to your library.', 'success')
+
+        # Take out what was just ordered, not anything added meanwhile (e.g. in another tab)
+        cart_store.remove(get_db(), user_id, cart_ids)
         return redirect(url_for('library'))
 
     # For GET request, just show the cart contents again (or a confirmation page)
     # For simplicity, we'll reuse the cart view for checkout confirmation.
-    placeholders = ','.join(['?'] * len(cart_ids))
-    games_in_cart = query_db(f'SELECT * FROM games WHERE id IN ({placeholders})', list(cart_ids))
+    games_in_cart = get_games(cart_ids)
     total_price = sum(game['price'] for game in games_in_cart)
-    cart_item_count = len(session.get('cart', {}))
+    cart_item_count = get_cart_count()
 
-    return render_template('checkout.html', games_in_cart=games_in_cart, total_price=total_price, cart_item_count=cart_item_count)
+    # Fresh key per rendered form; resubmitting this form reuses it
+    return render_template('checkout.html', games_in_cart=games_in_cart, total_price=total_price,
+                           cart_item_count=cart_item_count, idempotency_key=str(uuid.uuid4()))
 
 @app.route('/buy_now/<int:game_id>')
 def buy_now(game_id):
@@ -222,34 +1040,226 @@ def buy_now(game_id):
         flash('Please log in to purchase items.', 'warning')
         return redirect(url_for('login'))
 
-    game = query_db('SELECT * FROM games WHERE id = ?', [game_id], one=True)
+    game = get_game(game_id)
     if not game:
         flash('Game not found.', 'danger')
         return redirect(url_for('index'))
 
+    # Nothing to buy; checked against this worker's ownership index only,
+    # checkout itself makes sure of it
+    if ownership_index.owns(get_shard_db(session['user_id']), session['user_id'], game_id):
+        flash(f"You already own '{game['title']}'.", 'info')
+        return redirect(url_for('library'))
+
     # Add to cart logic (simplified from add_to_cart)
-    cart = session.get('cart', {})
-    cart[str(game_id)] = 1 # Add/ensure game is in cart
-    session['cart'] = cart
+    cart_store.add(get_db(), session['user_id'], [game_id]) # Add/ensure game is in cart
 
     # flash(f"'{game['title']}' added to cart, proceeding to checkout.", 'info') # Optional: can be noisy
     return redirect(url_for('checkout'))
 
 
+@app.route('/cache_stats')
+def cache_stats():
+    # Hit/miss/eviction counters for sizing GAME_CACHE_SIZE and FRAGMENT_CACHE_SIZE
+    return jsonify({**game_cache.stats(), 'fragments': fragment_cache.stats(), 'ownership': ownership_index.stats()})
+
+@app.route('/pool_stats')
+def pool_stats():
+    # Connection pool usage, including how long requests waited for a connection
+    stats = get_pool().stats()
+    if SHARD_COUNT > 1:
+        stats['shards'] = {database: get_pool(database).stats() for database in shard_router.databases()}
+    if GROUP_COMMIT:
+        # Batch sizes show how many writes share each commit
+        stats['group_commit'] = {database: writer.stats() for database, writer in _writers.items()}
+    return jsonify(stats)
+
+@app.route('/metrics')
+def metrics():
+    """Prometheus metrics for this worker process."""
+    lines = route_metrics.render()
+    for cache_name, cache in (('game_cache', game_cache), ('fragment_cache', fragment_cache),
+                              ('ownership_index', ownership_index)):
+        for name, value in cache.stats().items():
+            if name in ('hits', 'misses', 'evictions'):
+                lines += [f'# TYPE {cache_name}_{name}_total counter', f'{cache_name}_{name}_total {value}']
+    pool = get_pool().stats()
+    lines += ['# TYPE db_pool_acquired_total counter', f"db_pool_acquired_total {pool['acquired']}",
+              '# TYPE db_pool_wait_seconds_total counter', f"db_pool_wait_seconds_total {pool['total_wait_seconds']}",
+              '# TYPE db_pool_open_connections gauge', f"db_pool_open_connections {pool['open']}"]
+    return '\n'.join(lines) + '\n', 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
+def export_databases(name):
+    # Sharded tables are read from every shard and merged
+    return shard_router.databases() if name in SHARDED_TABLES else [DATABASE]
+
+def export_response(name):
+    """Stream the `name` export to an API client, see exports.export_batches.
+
+    Query parameters: format (ndjson or csv), since (ISO date or datetime),
+    cursor (from the last row received) and limit.
+    """
+    if not EXPORT_API_TOKEN:
+        return jsonify({'error': 'exports are not enabled'}), 404
+    supplied = request.headers.get('Authorization', '')
+    if supplied.startswith('Bearer '):
+        supplied = supplied[len('Bearer '):]
+    if not hmac.compare_digest(supplied.encode(), EXPORT_API_TOKEN.encode()):
+        return jsonify({'error': 'invalid or missing token'}), 401
+
+    fmt = request.args.get('format', 'ndjson')
+    if fmt not in EXPORT_FORMATS:
+        return jsonify({'error': f"format must be one of {', '.join(EXPORT_FORMATS)}"}), 400
+    since = after = None
+    if request.args.get('since'):
+        since = parse_since(request.args['since'])
+        if since is None:
+            return jsonify({'error': 'since must be an ISO date or datetime'}), 400
+    if request.args.get('cursor'):
+        after = decode_cursor(request.args['cursor'])
+        if after is None:
+            return jsonify({'error': 'invalid cursor'}), 400
+    limit = request.args.get('limit', type=int)
+
+    chunks = (ndjson_chunks if fmt == 'ndjson' else csv_chunks)(
+        name, merged_export_batches(export_databases(name), name, since=since, after=after, limit=limit),
+        encode_cursor)
+    # Run the query and read the first batch before sending the 200, so an
+    # error there is still an error response rather than a truncated body
+    try:
+        first = next(chunks, '')
+    except sqlite3.Error as e:
+        return jsonify({'error': f'export failed: {e}'}), 500
+    return app.response_class(itertools.chain([first], chunks), mimetype='application/x-ndjson' if fmt == 'ndjson' else 'text/csv',
+                              headers={'Content-Disposition': f'attachment; filename={name}.{fmt}'})
+
+@app.route('/api/games')
+def export_games():
+    return export_response('games')
+
+@app.route('/api/purchases')
+def export_purchases():
+    return export_response('purchases')
+
+
+# Purchases live on the user's shard and games in the catalog, so the
+# library is read in two steps and joined by library_games()
+LIBRARY_QUERY = 'SELECT game_id, purchase_date FROM purchases WHERE user_id = ? ORDER BY purchase_date DESC'
+
+def library_games(purchases, db=None):
+    games = {game['id']: game for game in get_games([row['game_id'] for row in purchases], db=db)}
+    return [{**games[row['game_id']], 'purchase_date': row['purchase_date']}
+            for row in purchases if row['game_id'] in games]
+
+RECOMMENDATION_SEEDS_QUERY = 'SELECT game_id FROM purchases WHERE user_id = ? ORDER BY purchase_date DESC LIMIT ?'
+
+def recommendation_candidates(seed_ids, db=None):
+    """Ids of the games most similar to `seed_ids` (owned ones included), best first."""
+    if not seed_ids:
+        return []
+    placeholders = ','.join(['?'] * len(seed_ids))
+    rows = (db or get_db()).query(f'''
+        SELECT recommended_game_id FROM game_recommendations
+        WHERE game_id IN ({placeholders})
+        GROUP BY recommended_game_id
+        ORDER BY SUM(score) DESC, recommended_game_id
+    ''', seed_ids)
+    return [row[0] for row in rows]
+
+def recommended_games(user_id, purchase_version=None, seed_ids=None):
+    """Games to recommend to a user: table reads only, the scoring is done by build-recommendations."""
+    if seed_ids is None:
+        seed_ids = [row[0] for row in query_shard(user_id, RECOMMENDATION_SEEDS_QUERY,
+                                                  [user_id, RECOMMENDATION_SEED_GAMES])]
+    candidate_ids = recommendation_candidates(seed_ids)
+    owned_ids = ownership_index.owned_among(get_shard_db(user_id), user_id, candidate_ids, version=purchase_version)
+    return get_games([game_id for game_id in candidate_ids if game_id not in owned_ids][:RECOMMENDATIONS_SHOWN])
+
 # Placeholder for other routes - to be implemented later
 @app.route('/library')
 def library():
     if 'user_id' not in session:
         return redirect(url_for('login'))
-    # Fetch user's games
-    user_games = query_db('''
-        SELECT g.*, p.purchase_date FROM games g
-        JOIN purchases p ON g.id = p.game_id
-        WHERE p.user_id = ?
-        ORDER BY p.purchase_date DESC
-    ''', [session['user_id']])
-    cart_item_count = len(session.get('cart', {})) # For navbar
-    return render_template('library.html', games=user_games, cart_item_count=cart_item_count)
+    cart_item_count = get_cart_count() # For navbar
+
+    def render():
+        # Fetch user's games
+        purchases = query_shard(session['user_id'], LIBRARY_QUERY, [session['user_id']])
+        user_games = library_games(purchases)
+        # Purchases are newest first, like RECOMMENDATION_SEEDS_QUERY
+        recommended = recommended_games(session['user_id'], purchase_version,
+                                        seed_ids=[row['game_id'] for row in purchases[:RECOMMENDATION_SEED_GAMES]])
+        return render_template('library.html', games=user_games, cart_item_count=cart_item_count,
+                               recommended=recommended)
+
+    purchase_version = get_purchase_version(session['user_id'])
+    return conditional_render(
+        (session['user_id'], get_catalog_version(), purchase_version, cart_item_count,
+         get_user_counters(session['user_id'])['pending_received'], get_recommendations_version()),
+        render)
+
+# Friendships are stored as directed edges in the friends table:
+#   pending request:  one row (sender, receiver, 'pending')
+#   accepted:         two rows (a, b, 'accepted') and (b, a, 'accepted')
+# so "who are X's friends" is always a range scan on user_id_1, and whether
+# two users are connected is at most two primary-key lookups. Each edge is
+# stored on the shard of its user_id_1.
+
+def get_friendship(user_id, other_id):
+    """Return the friends row linking two users, or None.
+
+    Our own outgoing edge (an accepted friendship, or a request we sent) is
+    checked first, then a pending request the other user sent us.
+    """
+    edge_query = 'SELECT * FROM friends WHERE user_id_1 = ? AND user_id_2 = ?'
+    return (query_shard(user_id, edge_query, [user_id, other_id], one=True) or
+            query_shard(other_id, edge_query, [other_id, user_id], one=True))
+
+def flash_existing_friendship(friendship, current_user_id, gamertag):
+    if friendship['status'] == 'accepted':
+        flash(f"You are already friends with {gamertag}.", 'info')
+    elif friendship['user_id_1'] == current_user_id:
+        flash(f"You already sent a friend request to {gamertag}.", 'info')
+    else: # Request was sent by the other user
+        flash(f"{gamertag} has already sent you a friend request. Check your pending requests.", 'info')
+
+def send_friend_request(current_user_id, user_to_add):
+    try:
+        execute_db('INSERT INTO friends (user_id_1, user_id_2, status) VALUES (?, ?, ?)',
+                   [current_user_id, user_to_add['id'], 'pending'], database=shard_router.database_for(current_user_id))
+        flash(f"Friend request sent to {user_to_add['gamertag']}.", 'success')
+    except sqlite3.IntegrityError:
+        flash(f"Could not send friend request. You might already have a pending request with {user_to_add['gamertag']}.", 'warning')
+    except Exception as e:
+        flash(f'An error occurred: {str(e)}', 'danger')
+
+# The three lists on the friends page: (template key prefix, query for the
+# other users' ids, whether it has to ask every shard). Requests we received
+# are stored on their senders' shards; the users are looked up afterwards.
+FRIEND_LIST_QUERIES = {
+    # Current friends (status = 'accepted'): our outgoing accepted edges
+    'current_friends': ('friend', "SELECT user_id_2 FROM friends WHERE user_id_1 = ? AND status = 'accepted'", False),
+    # Pending requests received by current user
+    'pending_requests_received': ('sender', "SELECT user_id_1 FROM friends WHERE user_id_2 = ? AND status = 'pending'", True),
+    # Pending requests sent by current user
+    'pending_requests_sent': ('receiver', "SELECT user_id_2 FROM friends WHERE user_id_1 = ? AND status = 'pending'", False),
+}
+
+def get_users(user_ids, db=None):
+    """id -> (id, username, gamertag, friend_code) row for the given user ids."""
+    user_ids = list(set(user_ids))
+    placeholders = ','.join(['?'] * len(user_ids))
+    rows = (db or get_db()).query(f'SELECT id, username, gamertag, friend_code FROM users WHERE id IN ({placeholders})',
+                                  user_ids)
+    return {row['id']: row for row in rows}
+
+def build_friend_lists(list_ids, users):
+    # {list name: [user ids]} -> the template's lists of prefixed dicts
+    return {name: [{f'{prefix}_id': user_id,
+                    f'{prefix}_username': users[user_id]['username'],
+                    f'{prefix}_gamertag': users[user_id]['gamertag']}
+                   for user_id in list_ids[name] if user_id in users]
+            for name, (prefix, _, _) in FRIEND_LIST_QUERIES.items()}
 
 @app.route('/friends', methods=['GET'])
 def friends():
@@ -257,41 +1267,124 @@ def friends():
         return redirect(url_for('login'))
 
     current_user_id = session['user_id']
+    list_ids = {name: [row[0] for row in (query_all_shards(sql, [current_user_id]) if all_shards
+                                          else query_shard(current_user_id, sql, [current_user_id]))]
+                for name, (_, sql, all_shards) in FRIEND_LIST_QUERIES.items()}
+    # One lookup for everyone on the page, ourselves included for the friend code
+    users = get_users([current_user_id, *(user_id for ids in list_ids.values() for user_id in ids)])
+    session['friend_code'] = users[current_user_id]['friend_code'] # Ensure session has latest friend_code
+
+    cart_item_count = get_cart_count()
+    return render_template('friends.html', cart_item_count=cart_item_count,
+                           **build_friend_lists(list_ids, users))
+
+@app.route('/friends/suggestions')
+def friend_suggestions():
+    """People you may know: friends of friends, ranked by mutual friend count."""
+    if 'user_id' not in session:
+        return jsonify({'error': 'login required'}), 401
+
+    current_user_id = session['user_id']
+    limit = min(max(request.args.get('limit', FRIEND_SUGGESTION_LIMIT, type=int), 1), 50)
+
+    if SHARD_COUNT > 1:
+        return jsonify(sharded_friend_suggestions(current_user_id, limit))
+
+    # Every step is a range scan on (user_id_1, status, user_id_2). The
+    # fan-out cap bounds the work for users with very large friend lists.
+    rows = query_db('''
+        WITH my_friends AS (
+            SELECT user_id_2 AS friend_id FROM friends
+            WHERE user_id_1 = ? AND status = 'accepted'
+            LIMIT ?
+        ),
+        candidates AS (
+            SELECT f.user_id_2 AS user_id, COUNT(*) AS mutual_friends
+            FROM my_friends m
+            JOIN friends f ON f.user_id_1 = m.friend_id AND f.status = 'accepted'
+            WHERE f.user_id_2 != ?
+              -- already a friend, or a request we sent
+              AND NOT EXISTS (SELECT 1 FROM friends x WHERE x.user_id_1 = ? AND x.user_id_2 = f.user_id_2)
+              -- a request they sent us
+              AND NOT EXISTS (SELECT 1 FROM friends y WHERE y.user_id_1 = f.user_id_2 AND y.user_id_2 = ?)
+            GROUP BY f.user_id_2
+            ORDER BY mutual_friends DESC, f.user_id_2
+            LIMIT ?
+        )
+        SELECT u.id, u.username, u.gamertag, c.mutual_friends
+        FROM candidates c
+        JOIN users u ON u.id = c.user_id
+        ORDER BY c.mutual_friends DESC, u.id
+    ''', [current_user_id, FRIEND_SUGGESTION_FANOUT, current_user_id, current_user_id, current_user_id, limit])
+
+    return jsonify([{'id': row['id'], 'username': row['username'], 'gamertag': row['gamertag'],
+                     'mutual_friends': row['mutual_friends']} for row in rows])
+
+def sharded_friend_suggestions(current_user_id, limit):
+    # The query above, step by step across shards: our friends' edges are on
+    # their shards, so count their friends one shard at a time and merge here
+    my_friends = [row[0] for row in query_shard(current_user_id, '''
+        SELECT user_id_2 FROM friends WHERE user_id_1 = ? AND status = 'accepted' LIMIT ?
+    ''', [current_user_id, FRIEND_SUGGESTION_FANOUT])]
+    by_shard = {}
+    for friend_id in my_friends:
+        by_shard.setdefault(shard_router.database_for(friend_id), []).append(friend_id)
+    mutual_friends = Counter()
+    for database, friend_ids in by_shard.items():
+        placeholders = ','.join(['?'] * len(friend_ids))
+        mutual_friends.update(dict(get_shard_db(database=database).query(f'''
+            SELECT user_id_2, COUNT(*) FROM friends
+            WHERE user_id_1 IN ({placeholders}) AND status = 'accepted'
+            GROUP BY user_id_2
+        ''', friend_ids)))
+
+    # Ourselves, anyone we're already linked to, and anyone who sent us a request
+    excluded = {current_user_id}
+    excluded.update(row[0] for row in query_shard(current_user_id, 'SELECT user_id_2 FROM friends WHERE user_id_1 = ?',
+                                                  [current_user_id]))
+    excluded.update(row[0] for row in query_all_shards('SELECT user_id_1 FROM friends WHERE user_id_2 = ?',
+                                                       [current_user_id]))
+    top = heapq.nsmallest(limit, ((-count, user_id) for user_id, count in mutual_friends.items()
+                                  if user_id not in excluded))
+    users = get_users([user_id for _, user_id in top]) if top else {}
+    return [{'id': user_id, 'username': users[user_id]['username'], 'gamertag': users[user_id]['gamertag'],
+             'mutual_friends': -count} for count, user_id in top if user_id in users]
+
+@app.route('/games/<int:game_id>/friends')
+def friends_who_own(game_id):
+    """The user's friends who own a game."""
+    if 'user_id' not in session:
+        return jsonify({'error': 'login required'}), 401
 
-    # Fetch current friends (status = 'accepted')
-    # We need to join with the users table twice to get friend's details
-    current_friends_data = query_db('''
-        SELECT u.id as friend_id, u.username as friend_username, u.gamertag as friend_gamertag
-        FROM friends f
-        JOIN users u ON (u.id = f.user_id_2 AND f.user_id_1 = ?) OR (u.id = f.user_id_1 AND f.user_id_2 = ?)
-        WHERE f.status = 'accepted' AND (f.user_id_1 = ? OR f.user_id_2 = ?) AND u.id != ?
-    ''', [current_user_id, current_user_id, current_user_id, current_user_id, current_user_id])
-
-    # Fetch pending requests received by current user
-    pending_requests_received_data = query_db('''
-        SELECT u.id as sender_id, u.username as sender_username, u.gamertag as sender_gamertag
-        FROM friends f
-        JOIN users u ON u.id = f.user_id_1
-        WHERE f.user_id_2 = ? AND f.status = 'pending'
-    ''', [current_user_id])
-
-    # Fetch pending requests sent by current user
-    pending_requests_sent_data = query_db('''
-        SELECT u.id as receiver_id, u.username as receiver_username, u.gamertag as receiver_gamertag
-        FROM friends f
-        JOIN users u ON u.id = f.user_id_2
-        WHERE f.user_id_1 = ? AND f.status = 'pending'
-    ''', [current_user_id])
-
-    user_details = query_db('SELECT friend_code FROM users WHERE id = ?', [current_user_id], one=True)
-    session['friend_code'] = user_details['friend_code'] # Ensure session has latest friend_code
-
-    cart_item_count = len(session.get('cart', {}))
-    return render_template('friends.html',
-                           current_friends=current_friends_data,
-                           pending_requests_received=pending_requests_received_data,
-                           pending_requests_sent=pending_requests_sent_data,
-                           cart_item_count=cart_item_count)
+    current_user_id = session['user_id']
+    limit = min(max(request.args.get('limit', FRIENDS_WHO_OWN_LIMIT, type=int), 1), 100)
+    if SHARD_COUNT == 1:
+        # One query: a range scan of our accepted edges, then a primary-key
+        # probe of uq_purchases_user_game per friend
+        rows = query_db('''
+            SELECT u.id, u.username, u.gamertag
+            FROM friends f
+            JOIN purchases p ON p.user_id = f.user_id_2 AND p.game_id = ?
+            JOIN users u ON u.id = f.user_id_2
+            WHERE f.user_id_1 = ? AND f.status = 'accepted'
+            ORDER BY u.gamertag
+            LIMIT ?
+        ''', [game_id, current_user_id, limit])
+    else:
+        # Friends' purchases are on their own shards: the same probes, one query per shard
+        by_shard = {}
+        for row in query_shard(current_user_id, "SELECT user_id_2 FROM friends WHERE user_id_1 = ? AND status = 'accepted'",
+                               [current_user_id]):
+            by_shard.setdefault(shard_router.database_for(row[0]), []).append(row[0])
+        owner_ids = []
+        for database, friend_ids in by_shard.items():
+            placeholders = ','.join(['?'] * len(friend_ids))
+            owner_ids += [row[0] for row in get_shard_db(database=database).query(
+                f'SELECT user_id FROM purchases WHERE game_id = ? AND user_id IN ({placeholders})', [game_id, *friend_ids])]
+        users = get_users(owner_ids) if owner_ids else {}
+        rows = sorted(users.values(), key=lambda user: user['gamertag'])[:limit]
+
+    return jsonify([{'id': row['id'], 'username': row['username'], 'gamertag': row['gamertag']} for row in rows])
 
 @app.route('/add_friend_by_gamertag', methods=['POST'])
 def add_friend_by_gamertag():
@@ -316,40 +1409,13 @@ def add_friend_by_gamertag():
         return redirect(url_for('friends'))
 
     # Check if already friends or request pending
-    existing_friendship = query_db('''
-        SELECT * FROM friends
-        WHERE ((user_id_1 = ? AND user_id_2 = ?) OR (user_id_1 = ? AND user_id_2 = ?))
-    ''', [current_user_id, user_to_add['id'], user_to_add['id'], current_user_id], one=True)
-
+    existing_friendship = get_friendship(current_user_id, user_to_add['id'])
     if existing_friendship:
-        if existing_friendship['status'] == 'accepted':
-            flash(f"You are already friends with {gamertag_to_add}.", 'info')
-        elif existing_friendship['status'] == 'pending':
-            if existing_friendship['user_id_1'] == current_user_id:
-                 flash(f"You already sent a friend request to {gamertag_to_add}.", 'info')
-            else: # Request was sent by the other user
-                 flash(f"{gamertag_to_add} has already sent you a friend request. Check your pending requests.", 'info')
+        flash_existing_friendship(existing_friendship, current_user_id, gamertag_to_add)
         return redirect(url_for('friends'))
 
-    try:
-        # Ensure user_id_1 < user_id_2 to prevent duplicate pair entries in different orders
-        uid1, uid2 = sorted((current_user_id, user_to_add['id']))
-        execute_db('INSERT INTO friends (user_id_1, user_id_2, status) VALUES (?, ?, ?)',
-                   [uid1, uid2, 'pending' if uid1 == current_user_id else 'pending_reverse'])
-                   # 'pending_reverse' indicates user_id_2 initiated, but we store user_id_1 as the sender in the primary key structure.
-                   # This logic needs refinement for who is sender/receiver.
-                   # A simpler way: always store sender as user_id_1, receiver as user_id_2 in 'pending' state.
-
-        # Simpler approach: user_id_1 is always the initiator of the 'pending' request
-        execute_db('DELETE FROM friends WHERE (user_id_1 = ? AND user_id_2 = ?) OR (user_id_1 = ? AND user_id_2 = ?)',
-                   [current_user_id, user_to_add['id'], user_to_add['id'], current_user_id]) # Clear any old state
-        execute_db('INSERT INTO friends (user_id_1, user_id_2, status) VALUES (?, ?, ?)',
-                   [current_user_id, user_to_add['id'], 'pending'])
-        flash(f'Friend request sent to {gamertag_to_add}.', 'success')
-    except sqlite3.IntegrityError:
-        flash(f'Could not send friend request. You might already have a pending request with {gamertag_to_add}.', 'warning')
-    except Exception as e:
-        flash(f'An error occurred: {str(e)}', 'danger')
+    # The sender is always user_id_1 of a 'pending' row
+    send_friend_request(current_user_id, user_to_add)
     return redirect(url_for('friends'))
 
 
@@ -376,30 +1442,12 @@ def add_friend_by_code():
         return redirect(url_for('friends'))
 
     # Check if already friends or request pending (similar to by_gamertag)
-    existing_friendship = query_db('''
-        SELECT * FROM friends
-        WHERE ((user_id_1 = ? AND user_id_2 = ?) OR (user_id_1 = ? AND user_id_2 = ?))
-    ''', [current_user_id, user_to_add['id'], user_to_add['id'], current_user_id], one=True)
-
+    existing_friendship = get_friendship(current_user_id, user_to_add['id'])
     if existing_friendship:
-        # (Similar flash messages as in add_friend_by_gamertag)
-        if existing_friendship['status'] == 'accepted':
-            flash(f"You are already friends with {user_to_add['gamertag']}.", 'info')
-        elif existing_friendship['status'] == 'pending':
-            if existing_friendship['user_id_1'] == current_user_id:
-                 flash(f"You already sent a friend request to {user_to_add['gamertag']}.", 'info')
-            else:
-                 flash(f"{user_to_add['gamertag']} has already sent you a friend request.", 'info')
+        flash_existing_friendship(existing_friendship, current_user_id, user_to_add['gamertag'])
         return redirect(url_for('friends'))
 
-    try:
-        execute_db('INSERT INTO friends (user_id_1, user_id_2, status) VALUES (?, ?, ?)',
-                   [current_user_id, user_to_add['id'], 'pending'])
-        flash(f"Friend request sent to {user_to_add['gamertag']}.", 'success')
-    except sqlite3.IntegrityError:
-        flash(f"Could not send friend request. You might already have a pending request with {user_to_add['gamertag']}.", 'warning')
-    except Exception as e:
-        flash(f'An error occurred: {str(e)}', 'danger')
+    send_friend_request(current_user_id, user_to_add)
     return redirect(url_for('friends'))
 
 @app.route('/accept_friend_request/<int:requester_id>')
@@ -408,11 +1456,29 @@ def accept_friend_request(requester_id):
         return redirect(url_for('login'))
     current_user_id = session['user_id']
 
-    # In 'friends' table, user_id_1 is sender, user_id_2 is receiver (current_user_id)
-    # when status is 'pending'
+    # The pending row is (requester, current user). Accepting flips it and adds
+    # the reverse edge, in one transaction so the pair is never half-written.
+    accept_sql = "UPDATE friends SET status = 'accepted' WHERE user_id_1 = ? AND user_id_2 = ? AND status = 'pending'"
+    # An upsert rather than INSERT OR REPLACE, whose implicit delete would skip the counter triggers
+    reverse_edge_sql = '''
+        INSERT INTO friends (user_id_1, user_id_2, status) VALUES (?, ?, 'accepted')
+        ON CONFLICT (user_id_1, user_id_2) DO UPDATE SET status = 'accepted'
+    '''
+    def accept(db):
+        if db.execute(accept_sql, [requester_id, current_user_id]).rowcount:
+            db.execute(reverse_edge_sql, [current_user_id, requester_id])
+
     try:
-        execute_db("UPDATE friends SET status = 'accepted' WHERE user_id_1 = ? AND user_id_2 = ? AND status = 'pending'",
-                   [requester_id, current_user_id])
+        requester_database, own_database = shard_router.database_for(requester_id), shard_router.database_for(current_user_id)
+        if requester_database == own_database:
+            write(accept, database=own_database)
+        elif query_shard(requester_id, 'SELECT 1 FROM friends WHERE user_id_1 = ? AND user_id_2 = ? AND status = ?',
+                         [requester_id, current_user_id, 'pending'], one=True):
+            # On two shards it takes two transactions. Our edge goes in first:
+            # if flipping the request then fails, it is still pending and
+            # accepting it again finishes the job.
+            execute_db(reverse_edge_sql, [current_user_id, requester_id], database=own_database)
+            execute_db(accept_sql, [requester_id, current_user_id], database=requester_database)
         flash('Friend request accepted!', 'success')
     except Exception as e:
         flash(f'An error occurred: {str(e)}', 'danger')
@@ -425,7 +1491,7 @@ def reject_friend_request(requester_id):
     current_user_id = session['user_id']
     try:
         execute_db("DELETE FROM friends WHERE user_id_1 = ? AND user_id_2 = ? AND status = 'pending'",
-                   [requester_id, current_user_id])
+                   [requester_id, current_user_id], database=shard_router.database_for(requester_id))
         flash('Friend request rejected.', 'info')
     except Exception as e:
         flash(f'An error occurred: {str(e)}', 'danger')
@@ -437,15 +1503,100 @@ def remove_friend(friend_id):
         return redirect(url_for('login'))
     current_user_id = session['user_id']
     try:
-        # Friendships are stored with (user_id_1, user_id_2), order might vary for 'accepted'
-        # So delete where current_user is either user_id_1 or user_id_2 and other user is friend_id
-        execute_db("DELETE FROM friends WHERE ((user_id_1 = ? AND user_id_2 = ?) OR (user_id_1 = ? AND user_id_2 = ?)) AND status = 'accepted'",
-                   [current_user_id, friend_id, friend_id, current_user_id])
+        # Drop both directed edges of the friendship: two primary-key deletes,
+        # one transaction per shard the edges are on
+        edges = {}
+        for edge in [(current_user_id, friend_id), (friend_id, current_user_id)]:
+            edges.setdefault(shard_router.database_for(edge[0]), []).append(edge)
+        for database, shard_edges in edges.items():
+            write(lambda db, shard_edges: db.executemany(
+                "DELETE FROM friends WHERE user_id_1 = ? AND user_id_2 = ? AND status = 'accepted'", shard_edges),
+                shard_edges, database=database)
         flash('Friend removed.', 'info')
     except Exception as e:
         flash(f'An error occurred: {str(e)}', 'danger')
     return redirect(url_for('friends'))
 
+# Async variants of the friends, cart and library pages (see ASYNC_VIEWS).
+# They fetch the same data as the views above, but gather independent reads
+# concurrently, and take over those views' endpoints when async mode is on.
+
+async def load_user_counters_async(user_id):
+    # get_user_counters(), with the shards read concurrently
+    rows = await asyncio.gather(*(async_db.run(read_user_counters, user_id, database=database)
+                                  for database in shard_router.databases()))
+    g.user_counters = user_counters.add_counters(rows)
+    return g.user_counters
+
+async def friends_async():
+    if 'user_id' not in session:
+        return redirect(url_for('login'))
+
+    user_id = session['user_id']
+
+    async def list_ids(sql, all_shards):
+        databases = shard_router.databases() if all_shards else [shard_router.database_for(user_id)]
+        results = await asyncio.gather(*(async_db.query(sql, [user_id], database=database) for database in databases))
+        return [row[0] for rows in results for row in rows]
+
+    *lists, cart_item_count, _ = await asyncio.gather(
+        *(list_ids(sql, all_shards) for _, sql, all_shards in FRIEND_LIST_QUERIES.values()),
+        async_db.run(lambda db: cart_store.count(db, user_id)),
+        load_user_counters_async(user_id))
+    users = await async_db.run(get_users, [user_id, *(other_id for ids in lists for other_id in ids)])
+    session['friend_code'] = users[user_id]['friend_code']
+    return render_template('friends.html', cart_item_count=cart_item_count,
+                           **build_friend_lists(dict(zip(FRIEND_LIST_QUERIES, lists)), users))
+
+async def view_cart_async():
+    if 'user_id' not in session:
+        return redirect(url_for('login'))
+
+    user_id = session['user_id']
+    cart_ids, _, _ = await asyncio.gather(async_db.run(lambda db: cart_store.get(db, user_id)),
+                                          async_db.run(get_catalog_version),
+                                          load_user_counters_async(user_id))
+    games_in_cart = await async_db.run(get_games, cart_ids) if cart_ids else []
+    total_price = sum(game['price'] for game in games_in_cart)
+    return render_template('cart.html', games_in_cart=games_in_cart, total_price=total_price,
+                           cart_item_count=len(cart_ids))
+
+async def library_async():
+    if 'user_id' not in session:
+        return redirect(url_for('login'))
+
+    user_id = session['user_id']
+    shard = shard_router.database_for(user_id)
+    cart_item_count, purchase_version, catalog_version, counters, recommendations_version = \
+        await asyncio.gather(
+            async_db.run(lambda db: cart_store.count(db, user_id)),
+            async_db.run(get_purchase_version, user_id, database=shard),
+            async_db.run(get_catalog_version),
+            load_user_counters_async(user_id),
+            async_db.run(get_recommendations_version))
+
+    async def render():
+        purchases = await async_db.query(LIBRARY_QUERY, [user_id], database=shard)
+        # Purchases are newest first, like RECOMMENDATION_SEEDS_QUERY
+        seed_ids = [row['game_id'] for row in purchases[:RECOMMENDATION_SEED_GAMES]]
+        user_games, candidate_ids = await asyncio.gather(
+            async_db.run(library_games, purchases),
+            async_db.run(recommendation_candidates, seed_ids))
+        owned_ids = await async_db.run(lambda db: ownership_index.owned_among(
+            db, user_id, candidate_ids, version=purchase_version), database=shard)
+        recommended = await async_db.run(
+            get_games, [game_id for game_id in candidate_ids if game_id not in owned_ids][:RECOMMENDATIONS_SHOWN])
+        return render_template('library.html', games=user_games, cart_item_count=cart_item_count,
+                               recommended=recommended)
+
+    return await conditional_render_async(
+        (user_id, catalog_version, purchase_version, cart_item_count, counters['pending_received'],
+         recommendations_version),
+        render)
+
+if ASYNC_VIEWS:
+    app.view_functions.update(friends=friends_async, view_cart=view_cart_async, library=library_async)
+
 # Need to import 'g' for get_db()
 from flask import g
 
@@ -0,0 +1,35 @@
+# ASGI entry point for deployments that use an ASGI server, e.g.:
+#   GAME_STORE_ASYNC_VIEWS=1 uvicorn asgi:asgi_app --workers 4
+# Flask itself stays a WSGI app. asgiref's WsgiToAsgi would run every request
+# of a worker process on one shared thread, so requests would queue behind
+# each other; here each request runs on a thread of its own from a pool of
+# ASGI_THREADS, so one worker serves that many requests at the same time.
+# Async views still run their reads concurrently within a request.
+from concurrent.futures import ThreadPoolExecutor
+
+from asgiref.sync import SyncToAsync
+from asgiref.wsgi import WsgiToAsgi, WsgiToAsgiInstance
+
+from app import DB_POOL_SIZE, app
+
+# More request threads than pooled connections would only wait for a connection
+ASGI_THREADS = DB_POOL_SIZE
+_executor = ThreadPoolExecutor(max_workers=ASGI_THREADS, thread_name_prefix='asgi')
+# The synchronous body of WsgiToAsgiInstance.run_wsgi_app, without its
+# thread_sensitive=True wrapper
+_run_wsgi_app = WsgiToAsgiInstance.__dict__['run_wsgi_app'].func
+
+
+class ThreadedWsgiToAsgiInstance(WsgiToAsgiInstance):
+    async def run_wsgi_app(self, body):
+        await SyncToAsync(_run_wsgi_app, thread_sensitive=False, executor=_executor)(self, body)
+
+
+class ThreadedWsgiToAsgi(WsgiToAsgi):
+    """WsgiToAsgi that runs each request on a thread from _executor."""
+
+    async def __call__(self, scope, receive, send):
+        await ThreadedWsgiToAsgiInstance(self.wsgi_application, self.duplicate_header_limit)(scope, receive, send)
+
+
+asgi_app = ThreadedWsgiToAsgi(app)
@@ -0,0 +1,58 @@
+import asyncio
+import contextvars
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from metrics import TrackedConnection
+
+
+class AsyncDatabase:
+    """Awaitable SQLite access for async views.
+
+    sqlite3 is blocking, so every call runs on a small thread pool. Each call
+    borrows its own connection from the worker's ConnectionPool, so calls
+    gathered with asyncio.gather() really run side by side (WAL lets readers
+    proceed concurrently); keep `threads` at or below the pool size. The
+    caller's context, including Flask's g and the request's query stats, is
+    carried into the thread.
+    """
+
+    def __init__(self, get_pool, threads=8, slow_threshold=None):
+        self.get_pool = get_pool
+        self.threads = threads
+        self.slow_threshold = slow_threshold
+        self._executor = None
+        self._pid = None
+
+    def _get_executor(self):
+        # Threads don't survive a fork; each worker process makes its own pool
+        if self._executor is None or self._pid != os.getpid():
+            self._executor = ThreadPoolExecutor(self.threads, thread_name_prefix='async-db')
+            self._pid = os.getpid()
+        return self._executor
+
+    def _call(self, fn, args, database):
+        pool = self.get_pool(database)
+        conn = pool.acquire()
+        try:
+            return fn(*args, db=TrackedConnection(conn, self.slow_threshold))
+        finally:
+            pool.release(conn)
+
+    async def run(self, fn, *args, database=None):
+        """Await fn(*args, db=<a pooled connection to `database`>) run on the thread pool.
+
+        `database` picks the pool passed to get_pool(); None is the default one.
+        """
+        context = contextvars.copy_context()
+        return await asyncio.get_running_loop().run_in_executor(
+            self._get_executor(), context.run, self._call, fn, args, database)
+
+    async def query(self, sql, args=(), one=False, database=None):
+        rows = await self.run(lambda db: db.query(sql, args), database=database)
+        return (rows[0] if rows else None) if one else rows
+
+    def shutdown(self):
+        if self._executor is not None and self._pid == os.getpid():
+            self._executor.shutdown(wait=False)
+        self._executor = None
@@ -0,0 +1,191 @@
+import html
+import json
+import platform
+import random
+import re
+import resource
+import sqlite3
+import statistics
+import subprocess
+import time
+import tracemalloc
+import uuid
+from datetime import datetime, timezone
+
+SEARCH_TERMS = ['cyber', 'dragon', 'star', 'kingdom', 'shadow raiders', 'neon', 'legends', 'rift']
+
+
+def percentile(sorted_values, pct):
+    if len(sorted_values) == 1:
+        return sorted_values[0]
+    return statistics.quantiles(sorted_values, n=100, method='inclusive')[pct - 1]
+
+
+def log_in(client, user):
+    # Set the session directly: we are measuring the routes, not password hashing
+    with client.session_transaction() as session:
+        session['user_id'] = user['id']
+        session['username'] = user['username']
+        session['gamertag'] = user['gamertag']
+
+
+def build_scenarios(rng, game_ids):
+    """(name, route rule, prepare, request) for every benchmarked route.
+
+    `prepare(client)` runs untimed before each request and its return value
+    is passed on; `request(client, prepared)` issues the timed request.
+    """
+    def fill_cart(client):
+        client.post('/cart/batch', json={'add': rng.sample(game_ids, min(3, len(game_ids)))})
+
+    def next_page_url(client):
+        # The "Next page" link of a listing, so the timed request is a keyset page
+        body = client.get('/?sort=price_desc').get_data(as_text=True)
+        match = re.search(r'href="([^"]*cursor=[^"]*)"', body)
+        return html.unescape(match.group(1)) if match else '/?sort=price_desc'
+
+    return [
+        ('storefront', '/', None, lambda client, _: client.get('/')),
+        ('storefront_filtered', '/', None,
+         lambda client, _: client.get(f"/?genre={rng.choice(['RPG', 'Racing', 'Puzzle', 'Shooter'])}&sort=newest")),
+        ('storefront_page_2', '/', next_page_url, lambda client, url: client.get(url)),
+        ('search', '/search', None, lambda client, _: client.get(f'/search?q={rng.choice(SEARCH_TERMS)}')),
+        ('autocomplete', '/search/autocomplete', None,
+         lambda client, _: client.get(f'/search/autocomplete?q={rng.choice(SEARCH_TERMS)[:3]}')),
+        ('library', '/library', None, lambda client, _: client.get('/library')),
+        ('friends', '/friends', None, lambda client, _: client.get('/friends')),
+        ('friend_suggestions', '/friends/suggestions', None, lambda client, _: client.get('/friends/suggestions')),
+        ('cart', '/cart', fill_cart, lambda client, _: client.get('/cart')),
+        ('checkout_get', '/checkout', fill_cart, lambda client, _: client.get('/checkout')),
+        ('checkout_post', '/checkout', fill_cart,
+         lambda client, _: client.post('/checkout', data={'idempotency_key': str(uuid.uuid4())})),
+    ]
+
+
+def run(app_module, requests=200, warmup=10, memory_samples=5, seed=1, progress=print):
+    """Drive each route through the Flask test client and collect statistics.
+
+    Returns a JSON-serialisable dict. Note that checkout_post buys games, so
+    run this against a generated database, not a real one.
+    """
+    rng = random.Random(seed)
+    app = app_module.app
+    db = sqlite3.connect(app_module.DATABASE)
+    db.row_factory = sqlite3.Row
+    max_user = db.execute('SELECT MAX(id) FROM users').fetchone()[0] or 0
+    game_ids = [row[0] for row in db.execute('SELECT id FROM games ORDER BY random() LIMIT 1000')]
+    users = []
+    while max_user and len(users) < 50:
+        user = db.execute('SELECT id, username, gamertag FROM users WHERE id >= ? LIMIT 1',
+                          [rng.randint(1, max_user)]).fetchone()
+        if user:
+            users.append(dict(user))
+    dataset = {table: db.execute(f'SELECT COUNT(*) FROM {table}').fetchone()[0] for table in ('users', 'games')}
+    db.close()
+    # Purchases and friend edges are spread over the shards
+    for table in ('purchases', 'friends'):
+        dataset[table] = 0
+        for database in app_module.shard_router.databases():
+            shard = sqlite3.connect(database)
+            dataset[table] += shard.execute(f'SELECT COUNT(*) FROM {table}').fetchone()[0]
+            shard.close()
+    dataset['shards'] = app_module.SHARD_COUNT
+    if not users or not game_ids:
+        raise RuntimeError('the database has no users or games; run flask generate-data first')
+
+    results = {}
+    for name, rule, prepare, do_request in build_scenarios(rng, game_ids):
+        client = app.test_client()
+        progress(f'  {name}...')
+        sql = {'queries': 0, 'sql_time': 0.0, 'rows': 0}
+
+        def one_request():
+            # Every request gets a fresh app context (and so a fresh g and pooled
+            # connection), as when serving: the test client would otherwise join
+            # the one the CLI pushed for the whole command
+            log_in(client, rng.choice(users))
+            with app.app_context():
+                prepared = prepare(client) if prepare else None
+            before = app_module.route_metrics.totals(rule)
+            with app.app_context():
+                start = time.perf_counter()
+                response = do_request(client, prepared)
+                elapsed = time.perf_counter() - start
+            after = app_module.route_metrics.totals(rule)
+            if response.status_code >= 500:
+                raise RuntimeError(f'{name}: HTTP {response.status_code}')
+            for key in sql:
+                sql[key] += after[key] - before[key]
+            return elapsed
+
+        for _ in range(warmup):
+            one_request()
+        sql.update(queries=0, sql_time=0.0, rows=0)
+        latencies = sorted(one_request() for _ in range(requests))
+        measured = dict(sql)
+
+        # Separate pass for memory: tracemalloc slows everything down
+        peak = 0
+        for _ in range(memory_samples):
+            tracemalloc.start()
+            one_request()
+            peak = max(peak, tracemalloc.get_traced_memory()[1])
+            tracemalloc.stop()
+
+        results[name] = {
+            'requests': requests,
+            'p50_ms': round(percentile(latencies, 50) * 1000, 3),
+            'p95_ms': round(percentile(latencies, 95) * 1000, 3),
+            'p99_ms': round(percentile(latencies, 99) * 1000, 3),
+            'mean_ms': round(statistics.fmean(latencies) * 1000, 3),
+            'queries_per_request': round(measured['queries'] / requests, 2),
+            'sql_ms_per_request': round(measured['sql_time'] / requests * 1000, 3),
+            'rows_per_request': round(measured['rows'] / requests, 1),
+            'peak_memory_kb': round(peak / 1024, 1),
+        }
+
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                                text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'created_at': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'commit': commit,
+        'python': platform.python_version(),
+        'sqlite': sqlite3.sqlite_version,
+        'dataset': dataset,
+        'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'routes': results,
+    }
+
+
+def compare(current, baseline, tolerance=0.2):
+    """Return a list of regression messages versus a previous run.
+
+    A route regresses when its p95 latency grows by more than `tolerance`
+    (a fraction) or when it issues more queries per request than before.
+    """
+    regressions = []
+    for name, now in current['routes'].items():
+        before = baseline.get('routes', {}).get(name)
+        if before is None:
+            continue
+        if now['p95_ms'] > before['p95_ms'] * (1 + tolerance):
+            regressions.append(f"{name}: p95 {before['p95_ms']} ms -> {now['p95_ms']} ms")
+        if now['queries_per_request'] > before['queries_per_request']:
+            regressions.append(f"{name}: queries/request {before['queries_per_request']} -> {now['queries_per_request']}")
+    return regressions
+
+
+def format_table(report):
+    lines = [f"{'route':<22}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'queries':>9}{'peak KB':>10}"]
+    for name, stats in report['routes'].items():
+        lines.append(f"{name:<22}{stats['p50_ms']:>10}{stats['p95_ms']:>10}{stats['p99_ms']:>10}"
+                     f"{stats['queries_per_request']:>9}{stats['peak_memory_kb']:>10}")
+    return '\n'.join(lines)
+
+
+def save(report, path):
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
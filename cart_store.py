@@ -0,0 +1,135 @@
+import threading
+import time
+from collections import OrderedDict
+
+from versioned_cache import UserVersions
+
+
+class CartStore:
+    """Server-side shopping carts keyed by user_id, stored in cart_items.
+
+    Carts of recently active users are also held in memory (bounded LRU).
+    By default every change is written straight through, and a cached cart
+    is only used while the user's cart version (bumped by triggers on
+    cart_items, see database_setup.migration_cart_versions) is unchanged, so
+    a read costs one primary-key lookup and changes made through another
+    worker are picked up. With write_back=True changes only update memory
+    and mark the cart dirty; flush() writes dirty carts out, and a dirty
+    cart is always flushed before it is evicted. Write-back trusts memory
+    and so assumes a user's requests reach the same worker process.
+
+    Every method that may touch the database takes the connection to use.
+    Given a GroupCommitWriter, write-through changes are queued to it
+    instead, and a method returns once its change is committed.
+    """
+
+    def __init__(self, max_users=10000, write_back=False, flush_interval=2.0, writer=None):
+        self.max_users = max_users
+        self.write_back = write_back
+        self.flush_interval = flush_interval
+        self.writer = writer
+        self._carts = OrderedDict() # user_id -> dict of game_id -> None (an ordered set)
+        self._versions = UserVersions('cart_versions') # checked in write-through mode only
+        self._dirty = set()
+        self._last_flush = time.monotonic()
+        self._lock = threading.RLock()
+
+    def _load(self, db, user_id):
+        # Caller holds the lock
+        cart = self._carts.get(user_id)
+        version = None if self.write_back else self._versions.read(db, user_id)
+        if cart is None or not self._versions.is_current(user_id, version):
+            rows = db.execute('SELECT game_id FROM cart_items WHERE user_id = ? ORDER BY added_at, game_id',
+                              [user_id]).fetchall()
+            cart = self._carts[user_id] = dict.fromkeys(row[0] for row in rows)
+            self._versions.loaded(user_id, version)
+            self._evict(db)
+        self._carts.move_to_end(user_id)
+        return cart
+
+    def _evict(self, db):
+        while len(self._carts) > self.max_users:
+            user_id = next(iter(self._carts))
+            if user_id in self._dirty:
+                self._write_cart(db, user_id)
+                db.commit()
+            del self._carts[user_id]
+            self._versions.discard(user_id)
+
+    def _write_cart(self, db, user_id):
+        # Replace the stored cart with the in-memory one
+        db.execute('DELETE FROM cart_items WHERE user_id = ?', [user_id])
+        db.executemany('INSERT INTO cart_items (user_id, game_id) VALUES (?, ?)',
+                       [(user_id, game_id) for game_id in self._carts[user_id]])
+        self._dirty.discard(user_id)
+
+    def _write_through(self, db, sql, rows):
+        # Caller holds the lock, so changes are queued in the order they were made;
+        # returns a Future to wait on after releasing it, or None
+        if self.writer is not None:
+            return self.writer.submit(lambda conn: conn.executemany(sql, rows).close())
+        db.executemany(sql, rows)
+        db.commit()
+        return None
+
+    def _wait(self, user_id, pending):
+        if pending is None:
+            return
+        try:
+            self.writer.wait(pending)
+        except Exception:
+            # Memory already has the change the database may not; reload next time
+            with self._lock:
+                self._carts.pop(user_id, None)
+                self._versions.discard(user_id)
+            raise
+
+    def get(self, db, user_id):
+        """Return the game ids in a user's cart, in the order they were added."""
+        with self._lock:
+            return list(self._load(db, user_id))
+
+    def count(self, db, user_id):
+        with self._lock:
+            return len(self._load(db, user_id))
+
+    def add(self, db, user_id, game_ids):
+        pending = None
+        with self._lock:
+            cart = self._load(db, user_id)
+            new_ids = [game_id for game_id in game_ids if game_id not in cart]
+            cart.update(dict.fromkeys(new_ids))
+            if self.write_back:
+                self._dirty.add(user_id)
+            elif new_ids:
+                pending = self._write_through(db, 'INSERT OR IGNORE INTO cart_items (user_id, game_id) VALUES (?, ?)',
+                                              [(user_id, game_id) for game_id in new_ids])
+        self._wait(user_id, pending)
+        return new_ids
+
+    def remove(self, db, user_id, game_ids):
+        pending = None
+        with self._lock:
+            cart = self._load(db, user_id)
+            removed = [game_id for game_id in game_ids if game_id in cart]
+            for game_id in removed:
+                del cart[game_id]
+            if self.write_back:
+                self._dirty.add(user_id)
+            elif removed:
+                pending = self._write_through(db, 'DELETE FROM cart_items WHERE user_id = ? AND game_id = ?',
+                                              [(user_id, game_id) for game_id in removed])
+        self._wait(user_id, pending)
+        return removed
+
+    def flush_due(self):
+        return self.write_back and bool(self._dirty) and \
+            time.monotonic() - self._last_flush >= self.flush_interval
+
+    def flush(self, db):
+        """Write every dirty cart to the database in one transaction."""
+        with self._lock:
+            for user_id in list(self._dirty):
+                self._write_cart(db, user_id)
+            db.commit()
+            self._last_flush = time.monotonic()
@@ -0,0 +1,194 @@
+import csv
+import itertools
+import json
+import math
+import sqlite3
+import time
+
+IMPORT_CHUNK_SIZE = 10_000
+
+# Columns an import may set. Rows with an id update that game (or create it
+# with that id); rows without one are added as new games. Any other columns,
+# such as the updated_at and cursor of an export file, are ignored.
+IMPORT_COLUMNS = ('title', 'description', 'price', 'genre', 'release_date', 'developer', 'image_url')
+REQUIRED_COLUMNS = ('title', 'price')
+MAX_INTEGER = 2 ** 63 - 1 # SQLite integers, and so game ids, are signed 64-bit
+MAX_PRICE = 1_000_000
+MAX_REPORTED_ERRORS = 10
+
+# Search index triggers, dropped together with the secondary indexes while
+# a deferred load runs and put back before the full-text index is rebuilt
+FTS_TRIGGERS = ('games_fts_insert', 'games_fts_update', 'games_fts_delete')
+# Catalog version triggers, also dropped by a deferred load, which bumps
+# the version once per chunk instead of once per row
+VERSION_TRIGGERS = ('games_bump_version_insert', 'games_bump_version_update', 'games_bump_version_delete')
+DEFERRED_TRIGGERS = FTS_TRIGGERS + VERSION_TRIGGERS
+BUMP_CATALOG_VERSION_SQL = 'UPDATE catalog_version SET version = version + 1, updated_at = CURRENT_TIMESTAMP WHERE id = 1'
+
+_assignments = ', '.join(f'{column} = excluded.{column}' for column in IMPORT_COLUMNS)
+_changed = (f"({', '.join(f'games.{column}' for column in IMPORT_COLUMNS)}) IS NOT "
+            f"({', '.join(f'excluded.{column}' for column in IMPORT_COLUMNS)})")
+# Unchanged rows are left alone, so they keep their updated_at and don't
+# show up in incremental exports or bump the catalog version. updated_at is
+# set here rather than by the games_set_updated_at triggers, whose extra
+# UPDATE per row would bump the catalog version a second time.
+UPSERT_SQL = f'''
+    INSERT INTO games (id, {', '.join(IMPORT_COLUMNS)}, updated_at)
+    VALUES (?, {', '.join('?' * len(IMPORT_COLUMNS))}, CURRENT_TIMESTAMP)
+    ON CONFLICT (id) DO UPDATE SET {_assignments}, updated_at = CURRENT_TIMESTAMP WHERE {_changed}
+'''
+INSERT_SQL = (f"INSERT INTO games ({', '.join(IMPORT_COLUMNS)}, updated_at) "
+              f"VALUES ({', '.join('?' * len(IMPORT_COLUMNS))}, CURRENT_TIMESTAMP)")
+
+
+def read_records(stream, fmt):
+    """Yield (line number, dict) for every record of a CSV or NDJSON stream."""
+    if fmt == 'csv':
+        reader = csv.DictReader(stream)
+        for record in reader:
+            yield reader.line_num, record
+    else:
+        for line_number, line in enumerate(stream, 1):
+            if line.strip():
+                try:
+                    yield line_number, json.loads(line)
+                except ValueError as e:
+                    yield line_number, e
+
+
+def to_row(record):
+    """(id or None, values in IMPORT_COLUMNS order) for one input record; raises ValueError.
+
+    Anything SQLite could not bind or store as given (nested values, ids out
+    of range) is rejected here, so one bad record skips that record only
+    rather than failing its whole chunk.
+    """
+    if not isinstance(record, dict):
+        raise ValueError(record if isinstance(record, Exception) else 'not an object')
+    missing = [column for column in REQUIRED_COLUMNS if record.get(column) in (None, '')]
+    if missing:
+        raise ValueError(f"missing {', '.join(missing)}")
+    for column in ('id',) + IMPORT_COLUMNS:
+        value = record.get(column)
+        if value is not None and (isinstance(value, bool) or not isinstance(value, (str, int, float))):
+            raise ValueError(f'{column} must be a string or a number')
+        if isinstance(value, int) and not -MAX_INTEGER - 1 <= value <= MAX_INTEGER:
+            raise ValueError(f'{column} is out of range')
+        if isinstance(value, str):
+            try:
+                value.encode('utf-8')
+            except UnicodeEncodeError: # a lone surrogate from a JSON \ud800 escape
+                raise ValueError(f'{column} is not valid text') from None
+    values = [record.get(column) or None for column in IMPORT_COLUMNS]
+    price = float(record['price'])
+    if not 0 <= price <= MAX_PRICE: # also false for nan
+        raise ValueError(f'price must be between 0 and {MAX_PRICE}')
+    values[IMPORT_COLUMNS.index('price')] = price
+    game_id = record.get('id')
+    if game_id in (None, ''):
+        return None, values
+    if isinstance(game_id, float) and not (math.isfinite(game_id) and game_id.is_integer()):
+        raise ValueError('id must be a whole number')
+    game_id = int(game_id)
+    if not 1 <= game_id <= MAX_INTEGER:
+        raise ValueError(f'id must be between 1 and {MAX_INTEGER}')
+    return game_id, values
+
+
+def defer_indexes(conn):
+    """Drop the secondary indexes on games and the search and version triggers, keeping their SQL.
+
+    The definitions are saved in deferred_schema in the same transaction, so
+    a load that dies half way can still be finished by restore_indexes().
+    """
+    with conn:
+        saved = conn.execute('''
+            SELECT type, name, sql FROM sqlite_master
+            WHERE tbl_name = 'games' AND sql IS NOT NULL AND (
+                (type = 'index' AND sql NOT LIKE 'CREATE UNIQUE%') OR
+                (type = 'trigger' AND name IN ({}))
+            )
+        '''.format(','.join('?' * len(DEFERRED_TRIGGERS))), DEFERRED_TRIGGERS).fetchall()
+        for kind, name, sql in saved:
+            conn.execute('INSERT OR REPLACE INTO deferred_schema (name, sql) VALUES (?, ?)', [name, sql])
+            conn.execute(f'DROP {kind.upper()} {name}')
+    return [name for _, name, _ in saved]
+
+
+def restore_indexes(conn, progress=print):
+    """Recreate whatever defer_indexes() dropped, then rebuild the full-text index."""
+    saved = conn.execute('SELECT name, sql FROM deferred_schema').fetchall()
+    if not saved:
+        return []
+    for name, sql in saved:
+        progress(f'  rebuilding {name}...')
+        with conn:
+            # DELETE first: it opens the transaction the CREATE then joins
+            conn.execute('DELETE FROM deferred_schema WHERE name = ?', [name])
+            conn.execute(sql)
+    if any(name in FTS_TRIGGERS for name, _ in saved):
+        progress('  rebuilding the search index...')
+        with conn:
+            conn.execute("INSERT INTO games_fts (games_fts) VALUES ('rebuild')")
+    with conn:
+        conn.execute('ANALYZE games')
+    return [name for name, _ in saved]
+
+
+def import_catalog(database, stream, fmt='csv', chunk_size=IMPORT_CHUNK_SIZE, defer=False, progress=print):
+    """Upsert games from a CSV or NDJSON stream in chunks of `chunk_size` rows.
+
+    Each chunk is one short write transaction, so the storefront keeps
+    reading (WAL) and writing between chunks. With defer=True the secondary
+    indexes and the search and version triggers are dropped for the load
+    and rebuilt at the end, and each chunk bumps the catalog version once;
+    the storefront stays up but is slower, and search is stale, until then.
+    Returns counts of rows read, written, unchanged and skipped.
+    """
+    conn = sqlite3.connect(database)
+    conn.execute('PRAGMA journal_mode = WAL')
+    conn.execute('PRAGMA busy_timeout = 30000') # wait for live writers rather than fail
+    conn.execute('PRAGMA cache_size = -200000')
+    counts = {'read': 0, 'written': 0, 'unchanged': 0, 'skipped': 0}
+    try:
+        # A previous deferred load that didn't finish
+        restore_indexes(conn, progress)
+        if defer:
+            progress(f"Deferring {', '.join(defer_indexes(conn))}...")
+
+        start = time.perf_counter()
+        records = read_records(stream, fmt)
+        while True:
+            chunk = list(itertools.islice(records, chunk_size))
+            if not chunk:
+                break
+            upserts, inserts = [], []
+            for line_number, record in chunk:
+                try:
+                    game_id, values = to_row(record)
+                except (ValueError, TypeError) as e:
+                    counts['skipped'] += 1
+                    if counts['skipped'] <= MAX_REPORTED_ERRORS:
+                        progress(f'  skipped line {line_number}: {e}')
+                    continue
+                if game_id is None:
+                    inserts.append(values)
+                else:
+                    upserts.append([game_id] + values)
+            with conn:
+                written = conn.executemany(UPSERT_SQL, upserts).rowcount if upserts else 0
+                if inserts:
+                    written += conn.executemany(INSERT_SQL, inserts).rowcount
+                if defer and written:
+                    conn.execute(BUMP_CATALOG_VERSION_SQL)
+            counts['read'] += len(chunk)
+            counts['written'] += written
+            counts['unchanged'] += len(upserts) + len(inserts) - written
+            progress(f"  {counts['read']:,} rows ({counts['read'] / (time.perf_counter() - start):,.0f}/s)")
+
+        if defer:
+            progress('Rebuilding deferred indexes...')
+            restore_indexes(conn, progress)
+    finally:
+        conn.close()
+    return counts
@@ -1,7 +1,9 @@
 import sqlite3
 
-def init_db():
-    conn = sqlite3.connect('game_store.db')
+DATABASE = 'game_store.db'
+
+def init_db(database=DATABASE, sample_data=True):
+    conn = sqlite3.connect(database)
     cursor = conn.cursor()
 
     # Users table
@@ -41,8 +43,9 @@ def init_db():
         )
     ''')
 
-    # Friends table (many-to-many relationship for users)
-    # status: 'pending', 'accepted'
+    # Friends table (many-to-many relationship for users), as directed edges:
+    # status 'pending': one row, user_id_1 sent the request to user_id_2
+    # status 'accepted': two rows, one in each direction
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS friends (
             user_id_1 INTEGER NOT NULL,
@@ -63,14 +66,334 @@ def init_db():
         ('Speed Kingdom', 'A high-octane racing game.', 49.99, 'Racing', '2023-08-20', 'Nitro Works', 'static/images/speed_kingdom.png')
     ]
 
-    cursor.executemany('''
-        INSERT OR IGNORE INTO games (title, description, price, genre, release_date, developer, image_url)
-        VALUES (?, ?, ?, ?, ?, ?, ?)
-    ''', sample_games)
+    # Shard files (see shard_router.py) share the schema but not the catalog
+    if sample_data:
+        cursor.executemany('''
+            INSERT OR IGNORE INTO games (title, description, price, genre, release_date, developer, image_url)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        ''', sample_games)
 
     conn.commit()
     conn.close()
 
+    # Bring the fresh schema up to the latest version
+    migrate(database)
+
+
+# Versioned migrations. Each function receives a cursor inside its own
+# transaction; its position in MIGRATIONS (1-based) is the schema version it
+# produces, recorded in the database with PRAGMA user_version. Only ever
+# append to this list: existing databases have already applied the entries
+# above the end.
+
+def migration_purchase_and_friend_indexes(cursor):
+    # library(): WHERE user_id = ? ORDER BY purchase_date DESC, joined on game_id
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_purchases_user_date ON purchases (user_id, purchase_date, game_id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_purchases_game ON purchases (game_id, user_id)')
+    # friends(): pending requests received, WHERE user_id_2 = ? AND status = ?
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_friends_user2_status ON friends (user_id_2, status, user_id_1)')
+
+def migration_unique_purchases(cursor):
+    # SQLite can't add a table constraint in place; a unique index enforces the
+    # same thing. Drop duplicate purchases first, keeping the earliest one.
+    cursor.execute('''
+        DELETE FROM purchases WHERE id NOT IN (
+            SELECT MIN(id) FROM purchases GROUP BY user_id, game_id
+        )
+    ''')
+    cursor.execute('CREATE UNIQUE INDEX IF NOT EXISTS uq_purchases_user_game ON purchases (user_id, game_id)')
+
+def migration_storefront_indexes(cursor):
+    # Storefront indexes: one per sort order, plus genre-prefixed variants for
+    # when the genre filter is applied. The trailing id matches the keyset
+    # cursor used by index() so each page is a single index range scan.
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_games_title ON games (title, id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_games_price ON games (price, id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_games_release_date ON games (release_date, id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_games_genre_title ON games (genre, title, id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_games_genre_price ON games (genre, price, id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_games_genre_release_date ON games (genre, release_date, id)')
+
+    # Catalog version: a single counter bumped by every write to games. The app
+    # compares it against its in-process game cache to know when to drop it.
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS catalog_version (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            version INTEGER NOT NULL
+        )
+    ''')
+    cursor.execute('INSERT OR IGNORE INTO catalog_version (id, version) VALUES (1, 1)')
+    for event in ('INSERT', 'UPDATE', 'DELETE'):
+        cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS games_bump_version_{event.lower()} AFTER {event} ON games
+            BEGIN
+                UPDATE catalog_version SET version = version + 1 WHERE id = 1;
+            END
+        ''')
+
+def migration_checkout_requests(cursor):
+    # Idempotency keys of completed checkouts, so a retried POST is a no-op
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS checkout_requests (
+            user_id INTEGER NOT NULL,
+            idempotency_key TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (user_id, idempotency_key),
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        )
+    ''')
+
+def migration_games_search(cursor):
+    # Full-text index over the catalog. External content: the text lives only
+    # in games, and the triggers below keep the index in step with it. The
+    # prefix indexes make autocomplete's "ab"* / "abc"* queries cheap.
+    cursor.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS games_fts USING fts5(
+            title, description, developer, genre,
+            content='games', content_rowid='id',
+            prefix='2 3', tokenize='unicode61 remove_diacritics 2'
+        )
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS games_fts_insert AFTER INSERT ON games
+        BEGIN
+            INSERT INTO games_fts (rowid, title, description, developer, genre)
+            VALUES (new.id, new.title, new.description, new.developer, new.genre);
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS games_fts_delete AFTER DELETE ON games
+        BEGIN
+            INSERT INTO games_fts (games_fts, rowid, title, description, developer, genre)
+            VALUES ('delete', old.id, old.title, old.description, old.developer, old.genre);
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS games_fts_update AFTER UPDATE ON games
+        BEGIN
+            INSERT INTO games_fts (games_fts, rowid, title, description, developer, genre)
+            VALUES ('delete', old.id, old.title, old.description, old.developer, old.genre);
+            INSERT INTO games_fts (rowid, title, description, developer, genre)
+            VALUES (new.id, new.title, new.description, new.developer, new.genre);
+        END
+    ''')
+    # Index whatever is already in the catalog
+    cursor.execute("INSERT INTO games_fts (games_fts) VALUES ('rebuild')")
+
+def migration_directed_friend_edges(cursor):
+    # Accepted friendships used to be one row in either direction. Store the
+    # missing reverse edge so adjacency is always a scan on user_id_1.
+    cursor.execute('''
+        INSERT OR REPLACE INTO friends (user_id_1, user_id_2, status)
+        SELECT user_id_2, user_id_1, 'accepted' FROM friends WHERE status = 'accepted'
+    ''')
+    # Leftover rows from an old add-friend code path
+    cursor.execute("DELETE FROM friends WHERE status = 'pending_reverse'")
+    # Covers the adjacency scans in friends() and the friend suggestions
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_friends_user1_status ON friends (user_id_1, status, user_id_2)')
+
+def migration_cart_items(cursor):
+    # Server-side carts (see cart_store.py), one row per game in a user's cart
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS cart_items (
+            user_id INTEGER NOT NULL,
+            game_id INTEGER NOT NULL,
+            added_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (user_id, game_id),
+            FOREIGN KEY (user_id) REFERENCES users (id),
+            FOREIGN KEY (game_id) REFERENCES games (id)
+        ) WITHOUT ROWID
+    ''')
+
+def migration_http_validators(cursor):
+    # Validators for conditional GETs: when the catalog last changed, and a
+    # per-user purchase version bumped whenever that user's purchases change.
+    cursor.execute('ALTER TABLE catalog_version ADD COLUMN updated_at TIMESTAMP')
+    cursor.execute('UPDATE catalog_version SET updated_at = CURRENT_TIMESTAMP')
+    for event in ('INSERT', 'UPDATE', 'DELETE'):
+        cursor.execute(f'DROP TRIGGER IF EXISTS games_bump_version_{event.lower()}')
+        cursor.execute(f'''
+            CREATE TRIGGER games_bump_version_{event.lower()} AFTER {event} ON games
+            BEGIN
+                UPDATE catalog_version SET version = version + 1, updated_at = CURRENT_TIMESTAMP WHERE id = 1;
+            END
+        ''')
+
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS purchase_versions (
+            user_id INTEGER PRIMARY KEY,
+            version INTEGER NOT NULL,
+            updated_at TIMESTAMP NOT NULL,
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        )
+    ''')
+    for event, row in (('INSERT', 'new'), ('UPDATE', 'new'), ('DELETE', 'old')):
+        cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS purchases_bump_version_{event.lower()} AFTER {event} ON purchases
+            BEGIN
+                INSERT INTO purchase_versions (user_id, version, updated_at)
+                VALUES ({row}.user_id, 1, CURRENT_TIMESTAMP)
+                ON CONFLICT (user_id) DO UPDATE SET version = version + 1, updated_at = CURRENT_TIMESTAMP;
+            END
+        ''')
+
+def migration_export_indexes(cursor):
+    # Incremental exports (see exports.py) read rows in (timestamp, id) order.
+    # Games get an updated_at column, maintained by the triggers below; rows
+    # that already exist count as changed now.
+    cursor.execute('ALTER TABLE games ADD COLUMN updated_at TIMESTAMP')
+    cursor.execute('UPDATE games SET updated_at = CURRENT_TIMESTAMP')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS games_set_updated_at_insert AFTER INSERT ON games
+        WHEN new.updated_at IS NULL
+        BEGIN
+            UPDATE games SET updated_at = CURRENT_TIMESTAMP WHERE id = new.id;
+        END
+    ''')
+    # Only when the writer didn't set updated_at itself, which also stops the
+    # trigger's own UPDATE from firing it again
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS games_set_updated_at_update AFTER UPDATE ON games
+        WHEN new.updated_at IS old.updated_at
+        BEGIN
+            UPDATE games SET updated_at = CURRENT_TIMESTAMP WHERE id = new.id;
+        END
+    ''')
+    # Touching updated_at (or price) doesn't change any indexed text
+    cursor.execute('DROP TRIGGER IF EXISTS games_fts_update')
+    cursor.execute('''
+        CREATE TRIGGER games_fts_update AFTER UPDATE OF title, description, developer, genre ON games
+        BEGIN
+            INSERT INTO games_fts (games_fts, rowid, title, description, developer, genre)
+            VALUES ('delete', old.id, old.title, old.description, old.developer, old.genre);
+            INSERT INTO games_fts (rowid, title, description, developer, genre)
+            VALUES (new.id, new.title, new.description, new.developer, new.genre);
+        END
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_games_updated_at ON games (updated_at, id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_purchases_date ON purchases (purchase_date, id)')
+
+def migration_deferred_schema(cursor):
+    # Index and trigger definitions set aside by `flask import-catalog --defer-indexes`
+    # (see catalog_import.py) until the load is done and they are rebuilt
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS deferred_schema (
+            name TEXT PRIMARY KEY,
+            sql TEXT NOT NULL
+        )
+    ''')
+
+def migration_user_counters(cursor):
+    # Per-user counts for the navbar and profile stats, kept up to date by
+    # triggers (see user_counters.py) instead of counting rows on every page
+    import user_counters
+    cursor.execute(f'''
+        CREATE TABLE IF NOT EXISTS user_counters (
+            user_id INTEGER PRIMARY KEY,
+            {', '.join(f'{column} INTEGER NOT NULL DEFAULT 0' for column in user_counters.COUNTER_COLUMNS)}
+        )
+    ''')
+    user_counters.create_triggers(cursor)
+    user_counters.rebuild(cursor)
+
+def migration_recommendations(cursor):
+    # Precomputed "similar games" lists, written by `flask build-recommendations`
+    # (see recommendations.py) so pages only read them. The watermarks are the
+    # last purchase id of each shard the previous run saw, and the version
+    # changes with every run, for conditional GETs of pages that show them.
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS game_recommendations (
+            game_id INTEGER NOT NULL,
+            rank INTEGER NOT NULL,
+            recommended_game_id INTEGER NOT NULL,
+            score REAL NOT NULL,
+            co_purchases INTEGER NOT NULL,
+            PRIMARY KEY (game_id, rank)
+        ) WITHOUT ROWID
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS recommendation_watermarks (
+            shard INTEGER PRIMARY KEY,
+            last_purchase_id INTEGER NOT NULL
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS recommendation_version (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            version INTEGER NOT NULL,
+            updated_at TIMESTAMP
+        )
+    ''')
+    cursor.execute('INSERT OR IGNORE INTO recommendation_version (id, version) VALUES (1, 0)')
+
+def migration_title_prefix_index(cursor):
+    # Case-insensitive title prefix ranges for search autocomplete
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_games_title_nocase ON games (title COLLATE NOCASE, id)')
+
+def migration_cart_versions(cursor):
+    # Per-user cart version, bumped on every change to cart_items, so a worker
+    # can tell whether its cached copy of a cart is current (see cart_store.py)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS cart_versions (
+            user_id INTEGER PRIMARY KEY,
+            version INTEGER NOT NULL
+        )
+    ''')
+    for event, row in (('INSERT', 'new'), ('UPDATE', 'new'), ('DELETE', 'old')):
+        cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS cart_items_bump_version_{event.lower()} AFTER {event} ON cart_items
+            BEGIN
+                INSERT INTO cart_versions (user_id, version) VALUES ({row}.user_id, 1)
+                ON CONFLICT (user_id) DO UPDATE SET version = version + 1;
+            END
+        ''')
+
+MIGRATIONS = [
+    migration_purchase_and_friend_indexes,
+    migration_unique_purchases,
+    migration_storefront_indexes,
+    migration_checkout_requests,
+    migration_games_search,
+    migration_directed_friend_edges,
+    migration_cart_items,
+    migration_http_validators,
+    migration_export_indexes,
+    migration_deferred_schema,
+    migration_user_counters,
+    migration_recommendations,
+    migration_title_prefix_index,
+    migration_cart_versions,
+]
+
+def schema_version(database=DATABASE):
+    conn = sqlite3.connect(database)
+    try:
+        return conn.execute('PRAGMA user_version').fetchone()[0]
+    finally:
+        conn.close()
+
+def migrate(database=DATABASE, target=None):
+    """Apply pending migrations in order; returns the versions applied."""
+    target = len(MIGRATIONS) if target is None else target
+    conn = sqlite3.connect(database, isolation_level=None) # we manage transactions
+    applied = []
+    try:
+        cursor = conn.cursor()
+        current = conn.execute('PRAGMA user_version').fetchone()[0]
+        for version in range(current + 1, target + 1):
+            cursor.execute('BEGIN IMMEDIATE')
+            try:
+                MIGRATIONS[version - 1](cursor)
+                cursor.execute(f'PRAGMA user_version = {version}')
+                cursor.execute('COMMIT')
+            except Exception:
+                cursor.execute('ROLLBACK')
+                raise
+            applied.append(version)
+    finally:
+        conn.close()
+    return applied
+
 if __name__ == '__main__':
     init_db()
     print("Database initialized with tables and sample game data.")
@@ -0,0 +1,107 @@
+import os
+import queue
+import sqlite3
+import threading
+import time
+
+
+class PoolTimeout(sqlite3.OperationalError):
+    """Raised when no pooled connection frees up within the pool timeout."""
+
+
+class ConnectionPool:
+    """A fixed-size pool of tuned SQLite connections for one worker process.
+
+    Connections are opened lazily up to `size`, have `pragmas` applied once
+    when they are opened, and are handed back and forth between request
+    threads (hence check_same_thread=False). A connection returned to the pool
+    has any open transaction rolled back so the next request starts clean.
+    """
+
+    def __init__(self, database, size=8, timeout=5.0, pragmas=None, cached_statements=256):
+        self.database = database
+        self.size = size
+        self.timeout = timeout
+        self.pragmas = dict(pragmas or {})
+        self.cached_statements = cached_statements
+        self.pid = os.getpid()
+        self._idle = queue.LifoQueue()
+        self._opened = 0
+        self._lock = threading.Lock()
+        # Wait-time accounting for acquire()
+        self.acquired = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def _open(self):
+        conn = sqlite3.connect(self.database, check_same_thread=False,
+                               cached_statements=self.cached_statements)
+        conn.row_factory = sqlite3.Row # Access columns by name
+        for name, value in self.pragmas.items():
+            conn.execute(f'PRAGMA {name} = {value}')
+        return conn
+
+    def acquire(self):
+        start = time.perf_counter()
+        try:
+            conn = self._idle.get_nowait()
+        except queue.Empty:
+            conn = None
+            with self._lock:
+                if self._opened < self.size:
+                    self._opened += 1
+                    opening = True
+                else:
+                    opening = False
+            if opening:
+                try:
+                    conn = self._open()
+                except Exception:
+                    with self._lock:
+                        self._opened -= 1
+                    raise
+            else:
+                try:
+                    conn = self._idle.get(timeout=self.timeout)
+                except queue.Empty:
+                    raise PoolTimeout(f'no database connection available after {self.timeout}s')
+
+        waited = time.perf_counter() - start
+        with self._lock:
+            self.acquired += 1
+            self.total_wait += waited
+            self.max_wait = max(self.max_wait, waited)
+        return conn
+
+    def release(self, conn):
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+        except sqlite3.Error:
+            # A connection we can't reset is not worth keeping
+            conn.close()
+            with self._lock:
+                self._opened -= 1
+            return
+        self._idle.put(conn)
+
+    def close(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+        with self._lock:
+            self._opened = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': self.size,
+                'open': self._opened,
+                'idle': self._idle.qsize(),
+                'acquired': self.acquired,
+                'total_wait_seconds': round(self.total_wait, 6),
+                'avg_wait_seconds': round(self.total_wait / self.acquired, 6) if self.acquired else 0.0,
+                'max_wait_seconds': round(self.max_wait, 6),
+            }
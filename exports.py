@@ -0,0 +1,123 @@
+import csv
+import heapq
+import io
+import itertools
+import json
+import sqlite3
+from datetime import datetime, timezone
+
+EXPORT_BATCH_SIZE = 1000
+
+# Exportable tables: columns, in output order, and the timestamp column that
+# orders the export. Rows come out ordered by (timestamp, id), served by the
+# indexes from database_setup.migration_export_indexes, so a (timestamp, id)
+# pair is both an incremental "since" bound and a resumable keyset cursor.
+EXPORTS = {
+    'games': {
+        'columns': ('id', 'title', 'description', 'price', 'genre', 'release_date', 'developer',
+                    'image_url', 'updated_at'),
+        'timestamp': 'updated_at',
+    },
+    'purchases': {
+        'columns': ('id', 'user_id', 'game_id', 'purchase_date'),
+        'timestamp': 'purchase_date',
+    },
+}
+EXPORT_FORMATS = ('ndjson', 'csv')
+
+
+def parse_since(value):
+    """Normalize an ISO date or datetime to SQLite's 'YYYY-MM-DD HH:MM:SS' (UTC); None if invalid.
+
+    A value with a UTC offset is converted to UTC; one without is taken as UTC.
+    """
+    try:
+        if value.endswith(('Z', 'z')): # fromisoformat() only accepts Z from Python 3.11
+            value = value[:-1] + '+00:00'
+        since = datetime.fromisoformat(value)
+    except (AttributeError, TypeError, ValueError):
+        return None
+    if since.tzinfo is not None:
+        since = since.astimezone(timezone.utc)
+    return since.strftime('%Y-%m-%d %H:%M:%S')
+
+
+def export_batches(database, name, since=None, after=None, limit=None, batch_size=EXPORT_BATCH_SIZE):
+    """Yield lists of rows of one export, at most `batch_size` rows at a time.
+
+    `since` keeps rows whose timestamp is at or after it; `after` is the
+    (timestamp, id) of the last row already received. Rows are read from one
+    statement with fetchmany() on a private read-only connection, so memory
+    stays flat however big the table is, the export is a consistent
+    snapshot, and a long export doesn't hold a pooled connection.
+    """
+    spec = EXPORTS[name]
+    ts = spec['timestamp']
+    where, args = [f'{ts} IS NOT NULL'], []
+    if since:
+        where.append(f'{ts} >= ?')
+        args.append(since)
+    if after:
+        where.append(f'({ts}, id) > (?, ?)')
+        args.extend(after)
+    limit_sql = ''
+    if limit:
+        limit_sql = 'LIMIT ?'
+        args.append(limit)
+
+    conn = sqlite3.connect(f'file:{database}?mode=ro', uri=True)
+    conn.row_factory = sqlite3.Row
+    try:
+        cursor = conn.execute(f'''
+            SELECT {', '.join(spec['columns'])} FROM {name}
+            WHERE {' AND '.join(where)}
+            ORDER BY {ts}, id {limit_sql}
+        ''', args)
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                return
+            yield rows
+    finally:
+        conn.close()
+
+
+def merged_export_batches(databases, name, since=None, after=None, limit=None, batch_size=EXPORT_BATCH_SIZE):
+    """export_batches() over several database files (shards), merged in (timestamp, id) order."""
+    if len(databases) == 1:
+        yield from export_batches(databases[0], name, since, after, limit, batch_size)
+        return
+    ts = EXPORTS[name]['timestamp']
+    # Each file is already in order, so merging only holds one batch per file
+    rows = heapq.merge(*(itertools.chain.from_iterable(export_batches(database, name, since, after, limit, batch_size))
+                         for database in databases),
+                       key=lambda row: (row[ts], row['id']))
+    rows = itertools.islice(rows, limit) if limit else rows
+    while True:
+        batch = list(itertools.islice(rows, batch_size))
+        if not batch:
+            return
+        yield batch
+
+
+def ndjson_chunks(name, batches, encode_cursor):
+    """One JSON object per line, each carrying the cursor to resume after it."""
+    ts = EXPORTS[name]['timestamp']
+    for rows in batches:
+        yield ''.join(json.dumps({**dict(row), 'cursor': encode_cursor(row[ts], row['id'])}) + '\n'
+                      for row in rows)
+
+
+def csv_chunks(name, batches, encode_cursor):
+    """A header line, then the rows with the resume cursor as the last column."""
+    spec = EXPORTS[name]
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(spec['columns'] + ('cursor',))
+    for rows in batches:
+        writer.writerows(tuple(row) + (encode_cursor(row[spec['timestamp']], row['id']),) for row in rows)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue() # header of an empty export
@@ -0,0 +1,25 @@
+from versioned_cache import VersionedCache
+
+
+class FragmentCache(VersionedCache):
+    """In-process LRU cache of rendered HTML fragments, per catalog version.
+
+    Keys are chosen by the caller, e.g. ('store', game_id), and must cover
+    everything the fragment is rendered from.
+    """
+
+    def __init__(self, max_size=4096):
+        super().__init__(max_size)
+
+    def get(self, key, render):
+        """Return the cached fragment for `key`, calling `render()` to build it on a miss."""
+        with self._lock:
+            fragment = self._lookup(key)
+            if fragment is not None:
+                return fragment
+            version = self.version
+
+        # Render outside the lock; two requests may occasionally render the same card
+        fragment = render()
+        self._store(version, [(key, fragment)])
+        return fragment
@@ -0,0 +1,30 @@
+from versioned_cache import VersionedCache
+
+
+class GameCache(VersionedCache):
+    """In-process LRU cache of `games` rows keyed by game id, per catalog version."""
+
+    def __init__(self, max_size=1024):
+        super().__init__(max_size)
+
+    def get_many(self, game_ids, loader):
+        """Return {game_id: row} for the ids that exist.
+
+        `loader` is called once with the list of ids that were not cached and
+        must return an iterable of rows (mappings with an 'id' key).
+        """
+        found, missing = {}, []
+        with self._lock:
+            for game_id in game_ids:
+                game = self._lookup(game_id)
+                if game is not None:
+                    found[game_id] = game
+                else:
+                    missing.append(game_id)
+            version = self.version
+
+        if missing:
+            loaded = {row['id']: dict(row) for row in loader(missing)}
+            found.update(loaded)
+            self._store(version, loaded.items())
+        return found
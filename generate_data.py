@@ -0,0 +1,140 @@
+import itertools
+import random
+import sqlite3
+import time
+import uuid
+
+from werkzeug.security import generate_password_hash
+
+# Production-like volumes; `flask generate-data --scale 0.01` builds a 1% copy
+DEFAULT_USERS = 2_000_000
+DEFAULT_GAMES = 200_000
+DEFAULT_PURCHASES = 30_000_000
+DEFAULT_AVG_FRIENDS = 20
+DEFAULT_PENDING_RATIO = 0.1 # pending requests per accepted friendship
+
+# Every generated user can log in with this password
+GENERATED_PASSWORD = 'password'
+CHUNK_SIZE = 50_000
+
+GENRES = ['RPG', 'Platformer', 'MMO', 'Puzzle', 'Racing', 'Shooter', 'Strategy', 'Simulation',
+          'Sports', 'Fighting', 'Horror', 'Adventure', 'Survival', 'Roguelike', 'Rhythm']
+TITLE_WORDS = ['Cyber', 'Pixel', 'Galaxy', 'Mystic', 'Speed', 'Shadow', 'Iron', 'Crystal', 'Neon',
+               'Dragon', 'Star', 'Forest', 'Kingdom', 'Legends', 'Raiders', 'Warriors', 'Chronicles',
+               'Odyssey', 'Tactics', 'Rising', 'Protocol', 'Horizon', 'Frontier', 'Echoes', 'Rift']
+STUDIO_WORDS = ['Future', 'Retro', 'Cosmic', 'Enigma', 'Nitro', 'Blue', 'Lunar', 'Atomic', 'Silver', 'Wild']
+STUDIO_SUFFIXES = ['Studios', 'Games Inc.', 'Interactive', 'Works', 'Entertainment', 'Labs']
+PRICES = [4.99, 9.99, 14.99, 19.99, 29.99, 39.99, 49.99, 59.99, 69.99]
+
+
+def chunked(iterable, size=CHUNK_SIZE):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def zipf_index(rng, n, skew=1.1):
+    """A 0-based index in [0, n) where low indexes are far more likely."""
+    while True:
+        index = int(rng.paretovariate(skew)) - 1
+        if index < n:
+            return index
+
+
+def insert_chunks(conn, sql, rows, label, progress):
+    """Insert `rows` with executemany, one transaction per chunk."""
+    total = 0
+    start = time.perf_counter()
+    for chunk in chunked(rows):
+        conn.executemany(sql, chunk)
+        conn.commit()
+        total += len(chunk)
+        progress(f'  {label}: {total:,} rows ({total / (time.perf_counter() - start):,.0f}/s)')
+    return total
+
+
+def generate(database, users=DEFAULT_USERS, games=DEFAULT_GAMES, purchases=DEFAULT_PURCHASES,
+             avg_friends=DEFAULT_AVG_FRIENDS, pending_ratio=DEFAULT_PENDING_RATIO, seed=42, progress=print):
+    """Fill an initialized (and migrated) database with synthetic data.
+
+    The same seed always produces the same data. Popularity is heavy-tailed:
+    a few games account for most purchases, and friendship degrees follow a
+    power law, so a handful of users have thousands of friends.
+    """
+    rng = random.Random(seed)
+    conn = sqlite3.connect(database)
+    # Bulk-load settings: this is a throwaway dataset, durability doesn't matter
+    conn.execute('PRAGMA journal_mode = WAL')
+    conn.execute('PRAGMA synchronous = OFF')
+    conn.execute('PRAGMA cache_size = -200000')
+
+    first_user = (conn.execute('SELECT MAX(id) FROM users').fetchone()[0] or 0) + 1
+    first_game = (conn.execute('SELECT MAX(id) FROM games').fetchone()[0] or 0) + 1
+
+    # One hash for everyone; hashing millions of passwords would take hours
+    password_hash = generate_password_hash(GENERATED_PASSWORD)
+    progress(f'Generating {users:,} users...')
+    insert_chunks(conn, 'INSERT INTO users (id, username, gamertag, password_hash, friend_code) VALUES (?, ?, ?, ?, ?)',
+                  ((user_id, f'user{user_id}', f'Gamer{user_id}', password_hash,
+                    str(uuid.UUID(int=rng.getrandbits(128), version=4)))
+                   for user_id in range(first_user, first_user + users)),
+                  'users', progress)
+
+    progress(f'Generating {games:,} games...')
+    def game_rows():
+        for game_id in range(first_game, first_game + games):
+            title = f'{rng.choice(TITLE_WORDS)} {rng.choice(TITLE_WORDS)} {game_id}'
+            description = ' '.join(rng.choices(TITLE_WORDS, k=rng.randint(20, 80))).lower() + '.'
+            studio = f'{rng.choice(STUDIO_WORDS)} {rng.choice(STUDIO_SUFFIXES)}'
+            release_date = None if rng.random() < 0.02 else \
+                f'{rng.randint(2000, 2025)}-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}'
+            yield (game_id, title, description, rng.choice(PRICES), rng.choice(GENRES), release_date, studio, None)
+    insert_chunks(conn, '''
+        INSERT INTO games (id, title, description, price, genre, release_date, developer, image_url)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    ''', game_rows(), 'games', progress)
+
+    progress(f'Generating ~{purchases:,} purchases...')
+    def purchase_rows():
+        # Heavy-tailed purchases per user, heavy-tailed game popularity
+        per_user = max(purchases / users, 1)
+        remaining = purchases
+        for user_id in range(first_user, first_user + users):
+            if remaining <= 0:
+                return
+            count = min(int(rng.expovariate(1 / per_user)) + 1, games, remaining)
+            owned = {first_game + zipf_index(rng, games) for _ in range(count)}
+            remaining -= len(owned)
+            for game_id in owned:
+                yield (user_id, game_id,
+                       f'{rng.randint(2020, 2025)}-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d} '
+                       f'{rng.randint(0, 23):02d}:{rng.randint(0, 59):02d}:{rng.randint(0, 59):02d}')
+    insert_chunks(conn, 'INSERT OR IGNORE INTO purchases (user_id, game_id, purchase_date) VALUES (?, ?, ?)',
+                  purchase_rows(), 'purchases', progress)
+
+    progress(f'Generating a power-law friendship graph (~{avg_friends} friends per user)...')
+    def friend_pairs(average):
+        # Each user starts ~average/2 connections; the other end is picked
+        # with a heavy tail so some users end up with very large friend lists.
+        for user_id in range(first_user, first_user + users):
+            for _ in range(int(rng.expovariate(2 / average)) if average else 0):
+                other_id = first_user + zipf_index(rng, users, skew=0.8)
+                if other_id != user_id:
+                    yield user_id, other_id
+    # Accepted friendships are two directed edges
+    insert_chunks(conn, "INSERT OR IGNORE INTO friends (user_id_1, user_id_2, status) VALUES (?, ?, 'accepted')",
+                  (edge for a, b in friend_pairs(avg_friends) for edge in ((a, b), (b, a))),
+                  'accepted friend edges', progress)
+    # Pending requests only between users who aren't connected yet
+    insert_chunks(conn, '''
+        INSERT OR IGNORE INTO friends (user_id_1, user_id_2, status)
+        SELECT ?, ?, 'pending' WHERE NOT EXISTS (SELECT 1 FROM friends WHERE user_id_1 = ? AND user_id_2 = ?)
+    ''', ((a, b, b, a) for a, b in friend_pairs(avg_friends * pending_ratio)), 'pending friend requests', progress)
+
+    progress('Updating planner statistics...')
+    conn.execute('ANALYZE')
+    conn.commit()
+    conn.close()
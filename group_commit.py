@@ -0,0 +1,188 @@
+import os
+import queue
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future
+from concurrent.futures import TimeoutError as FutureTimeout
+
+from metrics import TrackedConnection
+
+
+class GroupCommitWriter:
+    """Commits small write transactions from many request threads together.
+
+    submit(fn, *args) queues a job and returns a Future. One writer thread
+    per worker process takes every queued job, which under load includes
+    all those that arrived during the previous commit, optionally waits up
+    to `max_delay` seconds for more (at most `max_batch` in all), runs each
+    job as fn(db, *args) inside its own SAVEPOINT of a single transaction,
+    and commits once. A job that raises is rolled back on its own and its Future
+    gets the exception; the others still commit. Futures are only resolved
+    after the COMMIT, so a request that waited for one knows its write is
+    on disk, while the cost of the commit (an fsync with synchronous=FULL)
+    is shared by the whole batch.
+
+    Jobs must not commit or roll back themselves. If the writer thread dies
+    (say, the database can't be opened), every queued Future gets the error
+    and the next submit() starts a new thread. run() and wait() give up
+    after `timeout` seconds.
+    """
+
+    def __init__(self, database, max_batch=64, max_delay=0.0, pragmas=None, slow_threshold=None,
+                 timeout=30.0):
+        self.database = database
+        self.timeout = timeout
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.pragmas = dict(pragmas or {})
+        self.slow_threshold = slow_threshold
+        self.batches = 0
+        self.jobs = 0
+        self.failed_jobs = 0
+        self.max_batch_seen = 0
+        self._queue = None
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _start(self):
+        # Caller holds the lock. Threads don't survive a fork; each worker
+        # process starts its own writer, and a writer that died is replaced
+        if self._thread is None or self._pid != os.getpid() or not self._thread.is_alive():
+            self._queue = queue.Queue()
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, args=(self._queue,),
+                                            name='group-commit', daemon=True)
+            self._thread.start()
+        return self._queue
+
+    def _connect(self):
+        # Autocommit mode: the writer issues BEGIN/SAVEPOINT/COMMIT itself
+        conn = sqlite3.connect(self.database, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        for name, value in self.pragmas.items():
+            conn.execute(f'PRAGMA {name} = {value}')
+        return conn
+
+    def _next_batch(self, jobs):
+        batch = [jobs.get()]
+        deadline = time.monotonic() + self.max_delay
+        while len(batch) < self.max_batch:
+            try:
+                batch.append(jobs.get(timeout=max(deadline - time.monotonic(), 0)))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self, jobs):
+        conn, batch = None, []
+        try:
+            conn = self._connect()
+            db = TrackedConnection(conn, self.slow_threshold)
+            while True:
+                batch = self._next_batch(jobs)
+                if None in batch: # close()
+                    self._commit(db, [job for job in batch if job is not None])
+                    return
+                self._commit(db, batch)
+                batch = []
+        except BaseException as e:
+            self._fail(jobs, batch, e)
+            raise
+        finally:
+            if conn is not None:
+                conn.close()
+
+    def _fail(self, jobs, batch, error):
+        # The thread is going away: stop handing it jobs, then fail everything
+        # it took or was queued for it so no caller waits forever
+        with self._lock:
+            if self._queue is jobs:
+                self._thread = None
+            while True:
+                try:
+                    batch.append(jobs.get_nowait())
+                except queue.Empty:
+                    break
+        for job in batch:
+            if job is not None and not job[0].done():
+                job[0].set_exception(error)
+                self.failed_jobs += 1
+
+    def _commit(self, db, batch):
+        if not batch:
+            return
+        results = []
+        try:
+            db.execute('BEGIN IMMEDIATE')
+            for future, fn, args in batch:
+                db.execute('SAVEPOINT job')
+                try:
+                    results.append((future, fn(db, *args), None))
+                    db.execute('RELEASE job')
+                except Exception as e:
+                    db.execute('ROLLBACK TO job')
+                    db.execute('RELEASE job')
+                    results.append((future, None, e))
+            db.execute('COMMIT')
+        except Exception as e:
+            # BEGIN or COMMIT failed (e.g. the database stayed locked): nothing was written
+            try:
+                if db.in_transaction:
+                    db.execute('ROLLBACK')
+            except sqlite3.Error:
+                pass # the next BEGIN starts from a clean connection either way
+            for future, _, _ in batch:
+                future.set_exception(e)
+            self.failed_jobs += len(batch)
+            return
+        for future, result, error in results:
+            if error is None:
+                future.set_result(result)
+            else:
+                future.set_exception(error)
+                self.failed_jobs += 1
+        self.batches += 1
+        self.jobs += len(batch)
+        self.max_batch_seen = max(self.max_batch_seen, len(batch))
+
+    def submit(self, fn, *args):
+        """Queue fn(db, *args) for the next group commit; returns a Future of its result."""
+        future = Future()
+        with self._lock: # a dying writer drains its queue under the same lock
+            self._start().put((future, fn, args))
+        return future
+
+    def wait(self, future, timeout=None):
+        """Return the result of a submitted job, raising sqlite3.OperationalError
+        if its commit takes longer than `timeout` (default self.timeout) seconds."""
+        timeout = self.timeout if timeout is None else timeout
+        try:
+            return future.result(timeout)
+        except FutureTimeout:
+            raise sqlite3.OperationalError(f'group commit timed out after {timeout}s') from None
+
+    def run(self, fn, *args, timeout=None):
+        """submit() and wait for the commit; raises whatever fn raised."""
+        return self.wait(self.submit(fn, *args), timeout)
+
+    def close(self):
+        """Commit whatever is queued and stop the writer thread."""
+        with self._lock:
+            thread, alive = self._thread, self._thread is not None and self._pid == os.getpid()
+            if alive:
+                self._queue.put(None)
+            self._thread = None
+        if alive:
+            thread.join()
+
+    def stats(self):
+        return {
+            'batches': self.batches,
+            'jobs': self.jobs,
+            'failed_jobs': self.failed_jobs,
+            'avg_batch_size': round(self.jobs / self.batches, 2) if self.batches else 0,
+            'max_batch_size': self.max_batch_seen,
+            'queued': self._queue.qsize() if self._queue is not None else 0,
+        }
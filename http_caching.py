@@ -0,0 +1,69 @@
+import gzip
+import hashlib
+import os
+
+try:
+    import brotli # optional: pip install brotli
+except ImportError:
+    brotli = None
+
+COMPRESSIBLE_MIMETYPES = {'text/html', 'text/plain', 'text/css', 'application/json',
+                          'application/javascript', 'application/x-ndjson', 'text/csv'}
+
+
+def make_etag(*parts):
+    """A short opaque entity tag for the values a page was rendered from."""
+    return hashlib.sha1(repr(parts).encode()).hexdigest()[:20]
+
+
+def compress_response(response, accept_encoding, min_size=1024, gzip_level=6, brotli_quality=5):
+    """Compress a buffered text/JSON response in place if the client accepts it.
+
+    Brotli is preferred when the optional brotli package is installed.
+    Streamed responses, small bodies, and already-encoded bodies are left
+    alone.
+    """
+    if (response.direct_passthrough or response.is_streamed or
+            response.mimetype not in COMPRESSIBLE_MIMETYPES or
+            'Content-Encoding' in response.headers or not 200 <= response.status_code < 300):
+        return response
+    response.vary.add('Accept-Encoding')
+
+    data = response.get_data()
+    if len(data) < min_size:
+        return response
+    if brotli is not None and 'br' in accept_encoding:
+        response.set_data(brotli.compress(data, quality=brotli_quality))
+        response.headers['Content-Encoding'] = 'br'
+    elif 'gzip' in accept_encoding:
+        response.set_data(gzip.compress(data, compresslevel=gzip_level))
+        response.headers['Content-Encoding'] = 'gzip'
+    else:
+        return response
+    # A strong ETag names exact bytes; the compressed body is a different entity
+    if response.get_etag()[0] and not response.get_etag()[1]:
+        response.set_etag(response.get_etag()[0], weak=True)
+    return response
+
+
+class StaticFingerprints:
+    """Content hashes of static files, for cache-busting `?v=` URL parameters.
+
+    Hashes are cached per file and recomputed when its mtime changes.
+    """
+
+    def __init__(self, static_folder):
+        self.static_folder = static_folder
+        self._hashes = {}
+
+    def get(self, filename):
+        path = os.path.join(self.static_folder, filename)
+        try:
+            mtime = os.path.getmtime(path)
+        except OSError:
+            return None
+        cached = self._hashes.get(filename)
+        if cached is None or cached[0] != mtime:
+            with open(path, 'rb') as f:
+                cached = self._hashes[filename] = (mtime, hashlib.md5(f.read()).hexdigest()[:12])
+        return cached[1]
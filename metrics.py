@@ -0,0 +1,169 @@
+import bisect
+import logging
+import threading
+import time
+
+from flask import g, has_app_context
+
+slow_query_log = logging.getLogger('game_store.slow_queries')
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 250)
+
+
+class Histogram:
+    """Cumulative-bucket histogram in the shape Prometheus expects."""
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1) # last slot is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def lines(self, name, labels):
+        cumulative = 0
+        for bound, count in zip(self.buckets + ('+Inf',), self.counts):
+            cumulative += count
+            yield f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}'
+        yield f'{name}_sum{{{labels}}} {self.sum:.6f}'
+        yield f'{name}_count{{{labels}}} {self.count}'
+
+
+class QueryStats:
+    """SQL work done while serving one request."""
+
+    __slots__ = ('queries', 'sql_time', 'rows')
+
+    def __init__(self):
+        self.queries = 0
+        self.sql_time = 0.0
+        self.rows = 0
+
+
+class RouteMetrics:
+    """Per-route request latency and SQL usage for this worker process."""
+
+    def __init__(self):
+        self._routes = {}
+        self._lock = threading.Lock()
+
+    def observe(self, route, latency, stats):
+        with self._lock:
+            entry = self._routes.get(route)
+            if entry is None:
+                entry = self._routes[route] = {
+                    'latency': Histogram(LATENCY_BUCKETS),
+                    'queries_per_request': Histogram(QUERY_COUNT_BUCKETS),
+                    'queries': 0, 'sql_time': 0.0, 'rows': 0,
+                }
+            entry['latency'].observe(latency)
+            entry['queries_per_request'].observe(stats.queries)
+            entry['queries'] += stats.queries
+            entry['sql_time'] += stats.sql_time
+            entry['rows'] += stats.rows
+
+    def totals(self, route):
+        """Request count and SQL totals recorded so far for one route."""
+        with self._lock:
+            entry = self._routes.get(route)
+            if entry is None:
+                return {'requests': 0, 'queries': 0, 'sql_time': 0.0, 'rows': 0}
+            return {'requests': entry['latency'].count, 'queries': entry['queries'],
+                    'sql_time': entry['sql_time'], 'rows': entry['rows']}
+
+    def render(self):
+        """Return all route metrics in the Prometheus text exposition format."""
+        with self._lock:
+            routes = sorted(self._routes.items())
+            out = [
+                '# HELP http_request_duration_seconds Request latency by route.',
+                '# TYPE http_request_duration_seconds histogram',
+            ]
+            for route, entry in routes:
+                out.extend(entry['latency'].lines('http_request_duration_seconds', f'route="{route}"'))
+            out += [
+                '# HELP db_queries_per_request SQL statements issued per request, by route.',
+                '# TYPE db_queries_per_request histogram',
+            ]
+            for route, entry in routes:
+                out.extend(entry['queries_per_request'].lines('db_queries_per_request', f'route="{route}"'))
+            for name, key, help_text in (
+                    ('db_queries_total', 'queries', 'SQL statements executed, by route.'),
+                    ('db_query_seconds_total', 'sql_time', 'Time spent executing SQL, by route.'),
+                    ('db_rows_total', 'rows', 'Rows read or written by SQL, by route.')):
+                out += [f'# HELP {name} {help_text}', f'# TYPE {name} counter']
+                for route, entry in routes:
+                    value = entry[key]
+                    out.append(f'{name}{{route="{route}"}} {value:.6f}' if isinstance(value, float)
+                               else f'{name}{{route="{route}"}} {value}')
+            return out
+
+
+def request_stats():
+    """The QueryStats of the current request (a throwaway outside requests)."""
+    if not has_app_context():
+        return QueryStats()
+    if '_query_stats' not in g:
+        g._query_stats = QueryStats()
+    return g._query_stats
+
+
+class TrackedConnection:
+    """Wraps a sqlite3 connection and records every statement it runs.
+
+    Counts and timings go to the current request's QueryStats. A statement
+    slower than `slow_threshold` seconds is logged together with its
+    EXPLAIN QUERY PLAN. Anything not overridden here is passed through to the
+    underlying connection.
+    """
+
+    def __init__(self, conn, slow_threshold=None):
+        self.conn = conn
+        self.slow_threshold = slow_threshold
+
+    def __getattr__(self, name):
+        return getattr(self.conn, name)
+
+    def _record(self, sql, args, elapsed, rows):
+        stats = request_stats()
+        stats.queries += 1
+        stats.sql_time += elapsed
+        stats.rows += max(rows, 0)
+        if self.slow_threshold is not None and elapsed >= self.slow_threshold:
+            self.log_slow_query(sql, args, elapsed)
+
+    def query(self, sql, args=()):
+        # execute() + fetchall(), recorded as one statement including fetch time
+        start = time.perf_counter()
+        cursor = self.conn.execute(sql, args)
+        rows = cursor.fetchall()
+        cursor.close()
+        self._record(sql, args, time.perf_counter() - start, len(rows))
+        return rows
+
+    def log_slow_query(self, sql, args, elapsed):
+        try:
+            plan = [row[3] for row in self.conn.execute(f'EXPLAIN QUERY PLAN {sql}', args)]
+        except Exception as e: # e.g. PRAGMAs and transaction statements can't be explained
+            plan = [f'(no plan: {e})']
+        # Arguments are left out on purpose: they can hold password hashes and other user data
+        slow_query_log.warning('slow query (%.1f ms): %s\n  plan:\n    %s',
+                               elapsed * 1000, ' '.join(sql.split()), '\n    '.join(plan or ['(none)']))
+
+    def execute(self, sql, args=()):
+        start = time.perf_counter()
+        cursor = self.conn.execute(sql, args)
+        self._record(sql, args, time.perf_counter() - start, cursor.rowcount)
+        return cursor
+
+    def executemany(self, sql, seq_of_args):
+        seq_of_args = list(seq_of_args)
+        start = time.perf_counter()
+        cursor = self.conn.executemany(sql, seq_of_args)
+        self._record(sql, seq_of_args[0] if seq_of_args else (), time.perf_counter() - start, cursor.rowcount)
+        return cursor
@@ -0,0 +1,102 @@
+import bisect
+import threading
+from array import array
+from collections import OrderedDict
+
+from versioned_cache import UserVersions
+
+
+class OwnershipIndex:
+    """The game ids each user owns, as a sorted array('i') per user.
+
+    Arrays of recently active users are kept in a bounded LRU (bounded by
+    the total number of ids held, ~4 bytes each) and loaded from purchases
+    on a miss. Every array remembers the user's purchase version (see
+    database_setup.migration_http_validators) it was read at; callers that
+    know the current version pass it in and a stale array is reloaded, so
+    purchases made through another worker are picked up.
+
+    Every method that may touch the database takes the connection to use.
+    """
+
+    def __init__(self, max_ids=5_000_000):
+        self.max_ids = max_ids
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._size = 0
+        self._entries = OrderedDict() # user_id -> array of game ids
+        self._versions = UserVersions('purchase_versions')
+        self._lock = threading.Lock()
+
+    def _store(self, user_id, version, game_ids):
+        # Caller holds the lock
+        old = self._entries.pop(user_id, None)
+        if old is not None:
+            self._size -= len(old)
+        self._entries[user_id] = game_ids
+        self._versions.loaded(user_id, version)
+        self._size += len(game_ids)
+        while self._size > self.max_ids and len(self._entries) > 1:
+            evicted_user, evicted = self._entries.popitem(last=False)
+            self._versions.discard(evicted_user)
+            self._size -= len(evicted)
+            self.evictions += 1
+
+    def get(self, db, user_id, version=None):
+        """The user's owned game ids, sorted; reloaded if older than `version`."""
+        with self._lock:
+            if user_id in self._entries and self._versions.is_current(user_id, version):
+                self._entries.move_to_end(user_id)
+                self.hits += 1
+                return self._entries[user_id]
+            self.misses += 1
+        loaded_version = self._versions.read(db, user_id)
+        game_ids = array('i', (row[0] for row in db.execute(
+            'SELECT game_id FROM purchases WHERE user_id = ? ORDER BY game_id', [user_id])))
+        with self._lock:
+            self._store(user_id, loaded_version, game_ids)
+        return game_ids
+
+    def owned_among(self, db, user_id, game_ids, version=None):
+        """The subset of `game_ids` the user owns."""
+        owned = self.get(db, user_id, version)
+        found = set()
+        for game_id in game_ids:
+            i = bisect.bisect_left(owned, game_id)
+            if i < len(owned) and owned[i] == game_id:
+                found.add(game_id)
+        return found
+
+    def owns(self, db, user_id, game_id, version=None):
+        return bool(self.owned_among(db, user_id, [game_id], version))
+
+    def record_purchases(self, user_id, game_ids, version_before, version_after):
+        """Add ids the user just bought, moving the array from one purchase version to the next."""
+        with self._lock:
+            owned = self._entries.get(user_id)
+            if owned is None:
+                return # loaded from purchases on the next miss
+            if not self._versions.is_current(user_id, version_before):
+                # Missed some other write; start over from purchases
+                del self._entries[user_id]
+                self._versions.discard(user_id)
+                self._size -= len(owned)
+                return
+            owned = array('i', owned) # copy: readers may be holding the old array
+            for game_id in game_ids:
+                i = bisect.bisect_left(owned, game_id)
+                if i == len(owned) or owned[i] != game_id:
+                    owned.insert(i, game_id)
+            self._store(user_id, version_after, owned)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'users': len(self._entries),
+                'ids': self._size,
+                'max_ids': self.max_ids,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
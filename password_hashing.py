@@ -0,0 +1,99 @@
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from concurrent.futures import TimeoutError as FutureTimeout # only the builtin TimeoutError from 3.11
+
+from werkzeug.security import generate_password_hash, check_password_hash
+
+
+class HashingBusy(Exception):
+    """Raised when the hashing queue is full; the request should get a 503."""
+
+
+class PasswordHasher:
+    """Runs password hashing on a bounded pool of worker processes.
+
+    Hashing is deliberately slow, so doing it in the request thread lets a
+    burst of logins starve every other route. At most `workers + queue_depth`
+    hashes are in flight per web worker; past that, calls fail fast with
+    HashingBusy instead of piling up. With workers=0 hashing runs inline.
+
+    `method` is a full werkzeug method string including its cost parameters
+    (e.g. 'scrypt:32768:8:1' or 'pbkdf2:sha256:600000'), which is exactly the
+    prefix werkzeug stores in front of the hash. A stored hash with a
+    different prefix was made with outdated settings, see needs_rehash().
+
+    If a worker process dies (killed, out of memory), the pool is replaced
+    and the call retried once; if that fails too it raises HashingBusy.
+    """
+
+    def __init__(self, method='scrypt:32768:8:1', salt_length=16, workers=2, queue_depth=32, timeout=10.0):
+        self.method = method
+        self.salt_length = salt_length
+        self.workers = workers
+        self.timeout = timeout
+        self.pid = os.getpid()
+        self._slots = threading.BoundedSemaphore(workers + queue_depth) if workers else None
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                # spawn, not fork: forking a threaded web worker is unsafe
+                self._executor = ProcessPoolExecutor(max_workers=self.workers,
+                                                     mp_context=multiprocessing.get_context('spawn'))
+            return self._executor
+
+    def _discard(self, executor):
+        # A pool with a dead worker is broken for good; the next call starts a new one
+        with self._lock:
+            if self._executor is executor:
+                self._executor = None
+        executor.shutdown(wait=False)
+
+    def _run(self, fn, *args, **kwargs):
+        if not self.workers:
+            return fn(*args, **kwargs)
+        for _ in range(2):
+            if not self._slots.acquire(blocking=False):
+                raise HashingBusy('password hashing queue is full')
+            executor = self._get_executor()
+            try:
+                future = executor.submit(fn, *args, **kwargs)
+            except BrokenProcessPool:
+                self._slots.release()
+                self._discard(executor)
+                continue
+            except Exception:
+                self._slots.release()
+                raise
+            # Free the slot when the work finishes, even if we stop waiting for it
+            future.add_done_callback(lambda _: self._slots.release())
+            try:
+                return future.result(timeout=self.timeout)
+            except FutureTimeout:
+                raise HashingBusy(f'password hashing took longer than {self.timeout}s')
+            except BrokenProcessPool:
+                self._discard(executor)
+        raise HashingBusy('password hashing workers keep failing')
+
+    def hash(self, password):
+        return self._run(generate_password_hash, password, method=self.method, salt_length=self.salt_length)
+
+    def check(self, password_hash, password):
+        return self._run(check_password_hash, password_hash, password)
+
+    def needs_rehash(self, password_hash):
+        return password_hash.split('$', 1)[0] != self.method
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None:
+                try:
+                    self._executor.shutdown(wait=False, cancel_futures=True)
+                except TypeError: # cancel_futures is new in Python 3.9
+                    self._executor.shutdown(wait=False)
+                self._executor = None
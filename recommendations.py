@@ -0,0 +1,170 @@
+import heapq
+import math
+import sqlite3
+import time
+from array import array
+from collections import Counter, defaultdict
+
+try:
+    import numpy as np # optional: pip install numpy scipy
+    from scipy import sparse
+except ImportError:
+    np = sparse = None
+
+RECOMMENDATIONS_PER_GAME = 10
+MIN_CO_PURCHASES = 2 # pairs bought together less often than this are noise
+SCORE_BLOCK_SIZE = 1024 # games scored per sparse matrix product
+LOAD_BATCH_SIZE = 50_000
+
+
+def load_purchases(databases, watermarks=None):
+    """Every (user_id, game_id) purchase in `databases`, as two array('q').
+
+    Also returns the last purchase id of each database and, when
+    `watermarks` ({database index: last purchase id}) is given, the ids of
+    the games bought after them. Each file is read in one read transaction,
+    so its ids, pairs and new games agree with each other.
+    """
+    users, games = array('q'), array('q')
+    last_ids, new_games = {}, set()
+    for index, database in enumerate(databases):
+        conn = sqlite3.connect(f'file:{database}?mode=ro', uri=True)
+        try:
+            conn.execute('BEGIN')
+            last_ids[index] = conn.execute('SELECT COALESCE(MAX(id), 0) FROM purchases').fetchone()[0]
+            if watermarks is not None:
+                new_games.update(row[0] for row in conn.execute(
+                    'SELECT DISTINCT game_id FROM purchases WHERE id > ?', [watermarks.get(index, 0)]))
+            cursor = conn.execute('SELECT user_id, game_id FROM purchases')
+            while True:
+                rows = cursor.fetchmany(LOAD_BATCH_SIZE)
+                if not rows:
+                    break
+                for user_id, game_id in rows:
+                    users.append(user_id)
+                    games.append(game_id)
+        finally:
+            conn.close()
+    return users, games, last_ids, new_games
+
+
+def _top_k(candidates, k):
+    # (score, game id, co-purchases) tuples: best score first, then lowest id
+    return heapq.nsmallest(k, candidates, key=lambda candidate: (-candidate[0], candidate[1]))
+
+
+def similar_games_python(users, games, targets, k=RECOMMENDATIONS_PER_GAME, min_count=MIN_CO_PURCHASES):
+    """Yield (game id, top-k similar games) for each of `targets`, in plain Python.
+
+    Similarity is the cosine of two games' buyer sets: co-purchases divided
+    by the geometric mean of their buyer counts.
+    """
+    baskets, buyers = defaultdict(list), defaultdict(list)
+    for user_id, game_id in zip(users, games):
+        baskets[user_id].append(game_id)
+        buyers[game_id].append(user_id)
+    for game_id in targets:
+        co_purchases = Counter()
+        for user_id in buyers.get(game_id, ()):
+            co_purchases.update(baskets[user_id])
+        co_purchases.pop(game_id, None)
+        buyer_count = len(buyers.get(game_id, ()))
+        yield game_id, _top_k(((count / math.sqrt(buyer_count * len(buyers[other_id])), other_id, count)
+                               for other_id, count in co_purchases.items() if count >= min_count), k)
+
+
+def similar_games_sparse(users, games, targets, k=RECOMMENDATIONS_PER_GAME, min_count=MIN_CO_PURCHASES):
+    """similar_games_python(), computed as blocks of a sparse users x games matrix product."""
+    game_ids, game_index = np.unique(np.frombuffer(games, dtype=np.int64), return_inverse=True)
+    _, user_index = np.unique(np.frombuffer(users, dtype=np.int64), return_inverse=True)
+    owned = sparse.csr_matrix((np.ones(len(game_index)), (user_index, game_index)),
+                              shape=(user_index.max() + 1 if len(user_index) else 0, len(game_ids)))
+    owned.data[:] = 1 # (user, game) pairs are unique, but be safe
+    bought_by = owned.T.tocsr() # games x users
+    buyer_counts = np.diff(bought_by.indptr)
+
+    targets = np.asarray(sorted(targets), dtype=np.int64)
+    positions = np.searchsorted(game_ids, targets)
+    known = (positions < len(game_ids)) & (game_ids[np.minimum(positions, len(game_ids) - 1)] == targets)
+    for game_id in targets[~known]:
+        yield int(game_id), []
+    positions = positions[known]
+
+    for start in range(0, len(positions), SCORE_BLOCK_SIZE):
+        block = positions[start:start + SCORE_BLOCK_SIZE]
+        co_purchases = (bought_by[block] @ owned).tocsr() # block x games
+        for row, position in enumerate(block):
+            columns = co_purchases.indices[co_purchases.indptr[row]:co_purchases.indptr[row + 1]]
+            counts = co_purchases.data[co_purchases.indptr[row]:co_purchases.indptr[row + 1]]
+            keep = (columns != position) & (counts >= min_count)
+            columns, counts = columns[keep], counts[keep]
+            scores = counts / np.sqrt(buyer_counts[position] * buyer_counts[columns])
+            if len(scores) > k:
+                # Everything scoring at least the k-th best, ties included, then exact ordering
+                best = np.argpartition(-scores, k - 1)[:k]
+                keep = scores >= scores[best].min()
+                columns, counts, scores = columns[keep], counts[keep], scores[keep]
+            yield int(game_ids[position]), _top_k(
+                zip(scores.tolist(), game_ids[columns].tolist(), counts.astype(np.int64).tolist()), k)
+
+
+def similar_games(users, games, targets, k=RECOMMENDATIONS_PER_GAME, min_count=MIN_CO_PURCHASES):
+    """Top-k similar games per target, with NumPy/SciPy when installed."""
+    score = similar_games_sparse if sparse is not None else similar_games_python
+    return score(users, games, targets, k, min_count)
+
+
+def build_recommendations(catalog, databases, full=False, k=RECOMMENDATIONS_PER_GAME, progress=print):
+    """Refresh game_recommendations in `catalog` from the purchases in `databases` (the shards).
+
+    An incremental run only rescores the games bought since the previous
+    run. Their scores use the complete purchase history, but games that were
+    not bought meanwhile keep their lists (slightly stale as buyer counts
+    move) until the next full run. A run without watermarks for every shard,
+    such as the first one or the first after a reshard, is always full.
+    Returns counts of games rescored and recommendations written.
+    """
+    conn = sqlite3.connect(catalog)
+    conn.execute('PRAGMA busy_timeout = 30000')
+    try:
+        watermarks = dict(conn.execute('SELECT shard, last_purchase_id FROM recommendation_watermarks'))
+        full = full or set(watermarks) != set(range(len(databases)))
+        progress(f"Loading purchases ({'full' if full else 'incremental'} run)...")
+        users, games, last_ids, new_games = load_purchases(databases, None if full else watermarks)
+        targets = set(games) if full else new_games
+        progress(f"  {len(games):,} purchases, {len(targets):,} games to score "
+                 f"({'NumPy/SciPy' if sparse is not None else 'pure Python'})")
+
+        start = time.perf_counter()
+        counts = {'games': 0, 'recommendations': 0}
+        results = similar_games(users, games, targets, k)
+        while True:
+            chunk = [result for _, result in zip(range(SCORE_BLOCK_SIZE), results)]
+            if not chunk:
+                break
+            # A short write transaction per chunk; pages keep reading the old rows meanwhile
+            with conn:
+                conn.executemany('DELETE FROM game_recommendations WHERE game_id = ?',
+                                 [(game_id,) for game_id, _ in chunk])
+                conn.executemany('''
+                    INSERT INTO game_recommendations (game_id, rank, recommended_game_id, score, co_purchases)
+                    VALUES (?, ?, ?, ?, ?)
+                ''', [(game_id, rank, other_id, score, count)
+                      for game_id, similar in chunk
+                      for rank, (score, other_id, count) in enumerate(similar, 1)])
+            counts['games'] += len(chunk)
+            counts['recommendations'] += sum(len(similar) for _, similar in chunk)
+            progress(f"  {counts['games']:,} games ({counts['games'] / (time.perf_counter() - start):,.0f}/s)")
+
+        with conn:
+            if full:
+                # Games nobody owns any more
+                stale = {row[0] for row in conn.execute('SELECT DISTINCT game_id FROM game_recommendations')} - targets
+                conn.executemany('DELETE FROM game_recommendations WHERE game_id = ?', [(game_id,) for game_id in stale])
+                conn.execute('DELETE FROM recommendation_watermarks')
+            conn.executemany('INSERT OR REPLACE INTO recommendation_watermarks (shard, last_purchase_id) VALUES (?, ?)',
+                             last_ids.items())
+            conn.execute('UPDATE recommendation_version SET version = version + 1, updated_at = CURRENT_TIMESTAMP WHERE id = 1')
+    finally:
+        conn.close()
+    return counts
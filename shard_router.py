@@ -0,0 +1,192 @@
+import os
+import sqlite3
+import time
+import zlib
+from contextlib import ExitStack, contextmanager
+
+# User-owned tables and the column holding the owning user's id. Friend
+# edges belong to user_id_1, so a user's friend list is on their own shard.
+# purchase_versions and checkout_requests live next to the purchases their
+# triggers and transactions go with.
+SHARDED_TABLES = {
+    'purchases': 'user_id',
+    'friends': 'user_id_1',
+    'checkout_requests': 'user_id',
+    'purchase_versions': 'user_id', # last: copying purchases would otherwise bump it
+}
+# New purchase ids on each shard come from a range of its own SHARD_ID_STRIDE
+# ids (see seed_purchase_ids), so ids stay unique across shards: exports
+# merge shards by (purchase_date, id) and recommendation watermarks are ids
+SHARD_ID_STRIDE = 1 << 40
+RESHARD_CHUNK_SIZE = 50_000
+
+
+def shard_path(catalog, index):
+    """game_store.db -> game_store.shard<index>.db"""
+    root, ext = os.path.splitext(catalog)
+    return f'{root}.shard{index}{ext or ".db"}'
+
+
+class ShardRouter:
+    """Maps user ids to the SQLite file holding their rows of SHARDED_TABLES.
+
+    The catalog file keeps everything else (users, games, search, carts).
+    With a single shard that file is the catalog itself, so an unsharded
+    database needs no changes.
+    """
+
+    def __init__(self, catalog, shard_count=1):
+        if shard_count < 1:
+            raise ValueError('shard_count must be at least 1')
+        self.catalog = catalog
+        self.shard_count = shard_count
+
+    def shard_of(self, user_id):
+        if self.shard_count == 1:
+            return 0
+        # crc32 rather than user_id % n, so runs of ids spread evenly
+        return zlib.crc32(int(user_id).to_bytes(8, 'little', signed=True)) % self.shard_count
+
+    def database(self, index):
+        return self.catalog if self.shard_count == 1 else shard_path(self.catalog, index)
+
+    def database_for(self, user_id):
+        return self.database(self.shard_of(user_id))
+
+    def databases(self):
+        return [self.database(index) for index in range(self.shard_count)]
+
+
+@contextmanager
+def triggers_dropped(conn, table):
+    """Drop the triggers on `table` for the duration of a bulk copy or delete."""
+    saved = conn.execute("SELECT name, sql FROM sqlite_master WHERE type = 'trigger' AND tbl_name = ?",
+                         [table]).fetchall()
+    for name, _ in saved:
+        conn.execute(f'DROP TRIGGER {name}')
+    try:
+        yield
+    finally:
+        for _, sql in saved:
+            conn.execute(sql)
+
+
+def remove_database(path):
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+
+
+def seed_purchase_ids(conns):
+    """Give each shard (one connection per shard, in shard order) its own
+    range of new purchase ids, above every id any of them has used.
+
+    Needed whenever a layout of more than one shard is created; the caller commits.
+    """
+    if len(conns) < 2:
+        return
+    used = 0
+    for conn in conns:
+        used = max(used, conn.execute('SELECT MAX(id) FROM purchases').fetchone()[0] or 0,
+                   conn.execute("SELECT MAX(seq) FROM sqlite_sequence WHERE name = 'purchases'").fetchone()[0] or 0)
+    base = (used // SHARD_ID_STRIDE + 1) * SHARD_ID_STRIDE
+    for index, conn in enumerate(conns):
+        conn.execute("DELETE FROM sqlite_sequence WHERE name = 'purchases'")
+        conn.execute("INSERT INTO sqlite_sequence (name, seq) VALUES ('purchases', ?)",
+                     [base + index * SHARD_ID_STRIDE])
+
+
+def reshard(catalog, source_count, target_count, chunk_size=RESHARD_CHUNK_SIZE, progress=print):
+    """Move every row of SHARDED_TABLES from `source_count` shards to `target_count`.
+
+    Offline only: nothing else may be using the database. New shard files
+    are built next to the old ones and only swapped in once complete, so an
+    interrupted run leaves the old layout intact.
+    """
+    import database_setup
+    import user_counters
+    source, target = ShardRouter(catalog, source_count), ShardRouter(catalog, target_count)
+    if source_count == target_count:
+        return
+
+    # Fold every WAL into its database file, since files get replaced or removed below
+    for path in set(source.databases()) | {catalog}:
+        conn = sqlite3.connect(path)
+        conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        conn.close()
+
+    # Build into temporary files, except when going back to a single shard,
+    # which is the catalog itself and holds none of these rows yet
+    build_paths = []
+    for path in target.databases():
+        if path == catalog:
+            build_paths.append(path)
+            continue
+        build_path = path + '.reshard'
+        remove_database(build_path)
+        database_setup.init_db(build_path, sample_data=False)
+        build_paths.append(build_path)
+    outputs = [sqlite3.connect(path) for path in build_paths]
+    for conn in outputs:
+        conn.execute('PRAGMA synchronous = OFF')
+
+    start = time.perf_counter()
+    for table, column in SHARDED_TABLES.items():
+        copied = 0
+        with ExitStack() as stack:
+            for conn in outputs:
+                stack.enter_context(triggers_dropped(conn, table))
+            for path in source.databases():
+                conn = sqlite3.connect(path)
+                cursor = conn.execute(f'SELECT * FROM {table}')
+                columns = [description[0] for description in cursor.description]
+                owner = columns.index(column)
+                insert = f"INSERT OR REPLACE INTO {table} ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})"
+                while True:
+                    rows = cursor.fetchmany(chunk_size)
+                    if not rows:
+                        break
+                    by_shard = {}
+                    for row in rows:
+                        by_shard.setdefault(target.shard_of(row[owner]), []).append(row)
+                    for index, shard_rows in by_shard.items():
+                        outputs[index].executemany(insert, shard_rows)
+                    copied += len(rows)
+                    progress(f'  {table}: {copied:,} rows ({copied / (time.perf_counter() - start):,.0f}/s)')
+                conn.close()
+        for conn in outputs:
+            conn.commit()
+
+    seed_purchase_ids(outputs)
+    for conn in outputs:
+        # Counters were not copied (a shard also counts requests its users sent
+        # to users elsewhere), so recount them from the rows now in this file
+        user_counters.rebuild(conn)
+        conn.execute('ANALYZE')
+        conn.commit()
+        conn.close()
+
+    # Recommendation watermarks are per shard: the next build has to be a full one
+    conn = sqlite3.connect(catalog)
+    conn.execute('DELETE FROM recommendation_watermarks')
+    conn.commit()
+    conn.close()
+
+    # Swap the new layout in
+    for path, build_path in zip(target.databases(), build_paths):
+        if build_path != path:
+            remove_database(path)
+            os.replace(build_path, path)
+    for path in set(source.databases()) - set(target.databases()):
+        if path == catalog:
+            # The catalog was the only shard: its copies of the rows are now stale
+            progress('  clearing moved rows from the catalog...')
+            conn = sqlite3.connect(path)
+            for table in SHARDED_TABLES:
+                with triggers_dropped(conn, table):
+                    conn.execute(f'DELETE FROM {table}')
+            conn.execute('DELETE FROM user_counters')
+            conn.commit()
+            conn.close()
+        else:
+            remove_database(path)
@@ -0,0 +1,26 @@
+import importlib
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def make_app(tmp_path, monkeypatch):
+    """Import a fresh `app` module on a new database in tmp_path and run init-db.
+
+    Keyword arguments become GAME_STORE_<NAME> environment variables, e.g.
+    make_app(shards=3, export_token='t'), since app.py reads its settings at import.
+    """
+    def make(**settings):
+        monkeypatch.setenv('GAME_STORE_DATABASE', str(tmp_path / 'game_store.db'))
+        monkeypatch.setenv('GAME_STORE_JINJA_CACHE', str(tmp_path / 'jinja_cache'))
+        for name, value in settings.items():
+            monkeypatch.setenv(f'GAME_STORE_{name.upper()}', str(value))
+        module = importlib.reload(importlib.import_module('app'))
+        module.PASSWORD_HASH_WORKERS = 0
+        module.init_db_command()
+        return module
+    return make
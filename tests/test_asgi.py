@@ -0,0 +1,47 @@
+import asyncio
+import importlib
+import time
+
+SLOW = 0.5
+
+
+async def get(asgi_app, path):
+    scope = {'type': 'http', 'method': 'GET', 'path': path, 'root_path': '', 'query_string': b'',
+             'http_version': '1.1', 'headers': [], 'server': ('testserver', 80)}
+    messages = []
+
+    async def receive():
+        return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+    async def send(message):
+        messages.append(message)
+
+    await asgi_app(scope, receive, send)
+    return messages[0]['status']
+
+
+def test_slow_requests_overlap_in_one_worker(make_app):
+    app_module = make_app()
+
+    @app_module.app.route('/test/slow')
+    def slow():
+        time.sleep(SLOW)
+        return 'done'
+
+    @app_module.app.route('/test/slow-async')
+    async def slow_async():
+        await asyncio.sleep(SLOW)
+        return 'done'
+
+    asgi = importlib.reload(importlib.import_module('asgi'))
+
+    async def run_together():
+        start = time.perf_counter()
+        statuses = await asyncio.gather(get(asgi.asgi_app, '/test/slow'), get(asgi.asgi_app, '/test/slow'),
+                                        get(asgi.asgi_app, '/test/slow-async'), get(asgi.asgi_app, '/test/slow-async'))
+        return statuses, time.perf_counter() - start
+
+    statuses, elapsed = asyncio.run(run_together())
+    assert statuses == [200, 200, 200, 200]
+    # Serialized they would take 4 * SLOW
+    assert elapsed < 2 * SLOW
@@ -0,0 +1,44 @@
+import io
+import json
+import sqlite3
+
+import pytest
+
+from catalog_import import import_catalog, to_row
+
+BAD_RECORDS = [
+    {'title': {'x': 1}, 'price': 3},
+    {'title': ['a'], 'price': 3},
+    {'id': 99999999999999999999, 'title': 'Huge id', 'price': 3},
+    {'id': -5, 'title': 'Negative id', 'price': 3},
+    {'id': 1.5, 'title': 'Fractional id', 'price': 3},
+    {'title': 'Free money', 'price': -1},
+    {'title': 'Not a number', 'price': 'NaN'},
+    {'title': 'Forever', 'price': 'inf'},
+    {'title': 'Flag', 'price': True},
+    {'title': 'Big int', 'price': 3, 'developer': 2 ** 70},
+    {'title': '\ud800', 'price': 3},
+]
+
+
+@pytest.mark.parametrize('record', BAD_RECORDS)
+def test_to_row_rejects_values_sqlite_cannot_store(record):
+    with pytest.raises(ValueError):
+        to_row(record)
+
+
+def test_bad_records_are_skipped_without_losing_their_chunk(make_app):
+    app_module = make_app()
+    lines = [json.dumps({'title': 'Ok1', 'price': 1})]
+    lines += [json.dumps(record) for record in BAD_RECORDS]
+    lines += [json.dumps({'id': 5000, 'title': 'Ok2', 'price': '2.5'})]
+
+    counts = import_catalog(app_module.DATABASE, io.StringIO('\n'.join(lines)), fmt='ndjson',
+                            chunk_size=100, progress=lambda message: None)
+
+    assert counts['skipped'] == len(BAD_RECORDS)
+    assert counts['written'] == 2
+    conn = sqlite3.connect(app_module.DATABASE)
+    rows = conn.execute("SELECT id, title, price FROM games WHERE title LIKE 'Ok%' ORDER BY title").fetchall()
+    conn.close()
+    assert rows[0][1] == 'Ok1' and rows[1] == (5000, 'Ok2', 2.5)
@@ -0,0 +1,20 @@
+import pytest
+
+from exports import parse_since
+
+
+@pytest.mark.parametrize('value, expected', [
+    ('2024-01-01', '2024-01-01 00:00:00'),
+    ('2024-01-01T00:00:00', '2024-01-01 00:00:00'),
+    ('2024-01-01T00:00:00+05:00', '2023-12-31 19:00:00'),
+    ('2024-01-01T10:30:00-02:30', '2024-01-01 13:00:00'),
+    ('2024-01-01T00:00:00+00:00', '2024-01-01 00:00:00'),
+    ('2024-01-01T00:00:00Z', '2024-01-01 00:00:00'),
+])
+def test_parse_since_converts_offsets_to_utc(value, expected):
+    assert parse_since(value) == expected
+
+
+@pytest.mark.parametrize('value', ['yesterday', '', None, '2024-13-01'])
+def test_parse_since_rejects_invalid_values(value):
+    assert parse_since(value) is None
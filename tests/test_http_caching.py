@@ -0,0 +1,17 @@
+def test_not_modified_carries_the_etag_of_the_compressed_page(make_app):
+    app_module = make_app()
+    client = app_module.app.test_client()
+    with client.session_transaction() as session:
+        session['user_id'] = 1
+    headers = {'Accept-Encoding': 'gzip'}
+
+    page = client.get('/', headers=headers)
+    assert page.status_code == 200 and page.headers['Content-Encoding'] == 'gzip'
+    etag = page.headers['ETag']
+
+    revalidated = client.get('/', headers={**headers, 'If-None-Match': etag})
+    assert revalidated.status_code == 304
+    assert revalidated.headers['ETag'] == etag
+
+    uncompressed = client.get('/')
+    assert uncompressed.headers['ETag'] == etag
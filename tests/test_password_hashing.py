@@ -0,0 +1,21 @@
+import os
+import signal
+
+from werkzeug.security import check_password_hash
+
+from password_hashing import PasswordHasher
+
+
+def test_hash_succeeds_after_a_worker_process_is_killed():
+    hasher = PasswordHasher(method='pbkdf2:sha256:1000', workers=1, timeout=30.0)
+    try:
+        assert check_password_hash(hasher.hash('first'), 'first')
+        for process in list(hasher._executor._processes.values()):
+            os.kill(process.pid, signal.SIGKILL)
+            process.join()
+
+        password_hash = hasher.hash('second')
+        assert check_password_hash(password_hash, 'second')
+        assert hasher.check(password_hash, 'second')
+    finally:
+        hasher.shutdown()
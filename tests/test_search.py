@@ -0,0 +1,26 @@
+import re
+import sqlite3
+
+
+def test_old_exact_title_match_beats_newer_partial_matches(make_app):
+    app_module = make_app()
+    conn = sqlite3.connect(app_module.DATABASE)
+    conn.execute("INSERT INTO games (title, description, price, genre) VALUES ('Dragon', 'A quiet game.', 5, 'Puzzle')")
+    # Many newer games mentioning dragons everywhere, more than one page of bm25 scoring
+    conn.executemany('INSERT INTO games (title, description, price, genre) VALUES (?, ?, 10, ?)',
+                     [(f'Dragon Slayer {i}', 'Dragon dragon dragon.', 'Dragon') for i in range(1500)])
+    conn.commit()
+    conn.close()
+
+    client = app_module.app.test_client()
+    with client.session_transaction() as session:
+        session['user_id'] = 1
+    response = client.get('/search', query_string={'q': 'dragon'})
+    assert response.status_code == 200
+    titles = re.findall(r'<h3>([^<]*)', response.get_data(as_text=True))
+    assert titles[0].strip() == 'Dragon'
+    assert len(titles) == app_module.SEARCH_RESULTS_PER_PAGE
+
+    # The next page continues after the first one without repeating it
+    second = client.get('/search', query_string={'q': 'dragon', 'page': 2}).get_data(as_text=True)
+    assert not set(re.findall(r'<h3>([^<]*)', second)) & set(titles)
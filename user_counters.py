@@ -0,0 +1,85 @@
+COUNTER_COLUMNS = ('owned_games', 'friends', 'pending_received', 'pending_sent')
+
+# What user_counters should hold, computed from purchases and friends. A
+# user's pending_received is counted in the file holding the request, which
+# with several shards is the sender's, so a user's counters are the sum of
+# their rows in every shard.
+ACTUAL_COUNTERS_SQL = '''
+    SELECT user_id, SUM(owned_games), SUM(friends), SUM(pending_received), SUM(pending_sent) FROM (
+        SELECT user_id, COUNT(*) AS owned_games, 0 AS friends, 0 AS pending_received, 0 AS pending_sent
+        FROM purchases GROUP BY user_id
+        UNION ALL
+        SELECT user_id_1, 0, SUM(status = 'accepted'), 0, SUM(status = 'pending')
+        FROM friends GROUP BY user_id_1
+        UNION ALL
+        SELECT user_id_2, 0, 0, COUNT(*), 0
+        FROM friends WHERE status = 'pending' GROUP BY user_id_2
+    ) GROUP BY user_id
+'''
+STORED_COUNTERS_SQL = f'''
+    SELECT user_id, {', '.join(COUNTER_COLUMNS)} FROM user_counters
+    WHERE ({', '.join(COUNTER_COLUMNS)}) != ({', '.join('0' * len(COUNTER_COLUMNS))})
+'''
+
+
+def _bump(user, deltas):
+    # One statement adding `deltas` ({column: SQL expression}) to a user's row
+    columns = ', '.join(deltas)
+    updates = ', '.join(f'{column} = {column} + excluded.{column}' for column in deltas)
+    return (f"INSERT INTO user_counters (user_id, {columns}) VALUES ({user}, {', '.join(deltas.values())}) "
+            f"ON CONFLICT (user_id) DO UPDATE SET {updates};")
+
+
+def _purchase_counts(row, sign):
+    return [_bump(f'{row}.user_id', {'owned_games': f'{sign}1'})]
+
+
+def _friend_counts(row, sign):
+    # Accepted edges count for their user_id_1 (the reverse edge counts for the
+    # other user); a pending one for both the sender and the receiver
+    return [
+        _bump(f'{row}.user_id_1', {'friends': f"{sign}({row}.status = 'accepted')",
+                                   'pending_sent': f"{sign}({row}.status = 'pending')"}),
+        _bump(f'{row}.user_id_2', {'pending_received': f"{sign}({row}.status = 'pending')"}),
+    ]
+
+
+def create_triggers(cursor):
+    """Keep user_counters in step with every insert, update and delete on purchases and friends."""
+    for table, counts in (('purchases', _purchase_counts), ('friends', _friend_counts)):
+        for event, statements in (('INSERT', counts('new', '+')),
+                                  ('DELETE', counts('old', '-')),
+                                  ('UPDATE', counts('old', '-') + counts('new', '+'))):
+            cursor.execute(f'''
+                CREATE TRIGGER IF NOT EXISTS {table}_count_{event.lower()} AFTER {event} ON {table}
+                BEGIN
+                    {' '.join(statements)}
+                END
+            ''')
+
+
+def count_drift(db):
+    """Number of users whose stored counters differ from purchases and friends."""
+    return db.execute(f'''
+        SELECT COUNT(*) FROM (
+            SELECT user_id FROM ({ACTUAL_COUNTERS_SQL} EXCEPT {STORED_COUNTERS_SQL})
+            UNION
+            SELECT user_id FROM ({STORED_COUNTERS_SQL} EXCEPT {ACTUAL_COUNTERS_SQL})
+        )
+    ''').fetchone()[0]
+
+
+def rebuild(db):
+    """Recompute every row of user_counters; run it inside the caller's transaction."""
+    db.execute('DELETE FROM user_counters')
+    db.execute(f"INSERT INTO user_counters (user_id, {', '.join(COUNTER_COLUMNS)}) {ACTUAL_COUNTERS_SQL}")
+
+
+def add_counters(rows):
+    """Sum a user's rows (or None for no row) from several files into one dict."""
+    totals = dict.fromkeys(COUNTER_COLUMNS, 0)
+    for row in rows:
+        if row is not None:
+            for column in COUNTER_COLUMNS:
+                totals[column] += row[column]
+    return totals
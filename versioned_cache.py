@@ -0,0 +1,92 @@
+import threading
+from collections import OrderedDict
+
+
+class VersionedCache:
+    """Base for the in-process LRU caches whose entries belong to one catalog version.
+
+    When the caller observes a newer version (any write to `games` bumps it,
+    see database_setup), the whole cache is dropped before it is used again.
+    Subclasses look entries up with _lookup() while holding _lock, build the
+    missing ones outside it, and hand them to _store() with the version they
+    saw, so nothing built from an outdated catalog is kept.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.version = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def sync_version(self, version):
+        # Drop everything cached under an older catalog version
+        with self._lock:
+            if version != self.version:
+                self._entries.clear()
+                self.version = version
+
+    def _lookup(self, key):
+        # Caller holds the lock; None on a miss
+        value = self._entries.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def _store(self, version, items):
+        # Don't store values built under a version that has since been replaced
+        with self._lock:
+            if version != self.version:
+                return
+            for key, value in items:
+                self._entries[key] = value
+                self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': len(self._entries),
+                'max_size': self.max_size,
+                'version': self.version,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+
+class UserVersions:
+    """The version each user's entry in a per-user cache was read at.
+
+    `table` has one (user_id, version) row per user that triggers bump on
+    every change to that user's rows (purchase_versions, cart_versions). A
+    cache reads the version with read() before loading the rows and records
+    it with loaded(): if a change lands in between, the rows are newer than
+    their version and the next check just reloads them. Not locked; the
+    owning cache's lock covers it.
+    """
+
+    def __init__(self, table):
+        self.table = table
+        self._versions = {}
+
+    def read(self, db, user_id):
+        row = db.execute(f'SELECT version FROM {self.table} WHERE user_id = ?', [user_id]).fetchone()
+        return row[0] if row else 0
+
+    def is_current(self, user_id, version):
+        # version=None: the caller doesn't know it and takes any cached entry
+        return user_id in self._versions and (version is None or self._versions[user_id] == version)
+
+    def loaded(self, user_id, version):
+        self._versions[user_id] = version
+
+    def discard(self, user_id):
+        self._versions.pop(user_id, None)